@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+
+# asyncio interface for lib27gn950
+#
+# The functions here mirror the ones in lib27gn950, but they are coroutines
+#   that never block the event loop:
+#   - find_monitors() runs hid.enumerate() on a small, bounded thread pool
+#   - writes are queued to the per-device writer threads from writers.py, so
+#     each device still has exactly one writer, in submission order, shared
+#     with any non-asyncio code using lib27gn950 at the same time
+#
+# Any number of coroutines may call these concurrently. Each device accepts at
+#   most writers.queue_size queued writes at a time; further callers wait
+#   (asynchronously) for a free slot.
+#
+#
+# API documentation:
+#
+# await find_monitors()
+#   Same as lib27gn950.find_monitors()
+#
+#
+# await send_command(cmd, dev, force=False, timeout=None)
+# await send_raw_command(cmd, dev, force=False, timeout=None)
+# await send_frames(frames, dev, force=False, timeout=None)
+# await send_video_sync_frame(colors, dev, force=False, timeout=None)
+#   Same as the lib27gn950 functions of the same name. They return once the
+#     write has completed on every device, and raise the first error if any
+#     device failed.
+#   `timeout` is in seconds, per call. When it expires (or the calling task is
+#     cancelled), writes that haven't started yet are cancelled and
+#     asyncio.TimeoutError (or CancelledError) is raised. A write that is
+#     already in progress can't be interrupted, and will still complete.
+#
+#
+# executor
+#   The thread pool used for enumeration and for waiting on full queues
+
+################################################################################
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from queue import Full
+from threading import Lock
+from weakref import WeakKeyDictionary
+
+import calibration
+import lib27gn950
+import writers
+
+
+executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='aio27gn950')
+
+
+################################################################################
+
+async def find_monitors():
+	loop = asyncio.get_running_loop()
+	return await loop.run_in_executor(executor, lib27gn950.find_monitors)
+
+################################################################################
+
+async def send_command(cmd, dev, force=False, timeout=None):
+	if type(cmd) == str:
+		cmd = (cmd,)
+	frames = [lib27gn950.compile_command(_cmd) for _cmd in cmd]
+	await _run(lib27gn950._frames_job(frames, force), dev, timeout)
+
+async def send_raw_command(cmd, dev, force=False, timeout=None):
+	frames = lib27gn950.compile_raw_command(cmd)
+	await _run(lib27gn950._frames_job(frames, force), dev, timeout)
+
+async def send_frames(frames, dev, force=False, timeout=None):
+	await _run(lib27gn950._frames_job(frames, force), dev, timeout)
+
+################################################################################
+
+_encoder = None
+_encoder_lock = Lock()
+
+async def send_video_sync_frame(colors, dev, force=False, timeout=None):
+	global _encoder
+	devs = lib27gn950._device_list(dev)
+	# differently calibrated devices get different frames
+	groups = calibration.device_groups(devs) or [(None, devs)]
+	jobs = {}
+	with _encoder_lock:
+		if _encoder is None:
+			_encoder = lib27gn950.VideoSyncEncoder()
+		for profile, _devs in groups:
+			# the writes happen after this returns, so they can't share the
+			#   encoder's buffer with the next frame
+			reports = tuple(bytes(report) for report in _encoder.encode(colors, profile))
+			job = lib27gn950._video_sync_job(reports, _encoder.key(), force)
+			jobs.update((_dev, job) for _dev in _devs)
+	await _run_jobs(jobs, timeout)
+
+
+################################################################################
+################################################################################
+
+
+# per-device semaphores that keep the writer queues from filling up, so that
+#   submitting a job never blocks the event loop
+_slots = WeakKeyDictionary()
+
+def _slot(dev):
+	slot = _slots.get(dev)
+	if slot is None:
+		slot = _slots.setdefault(dev, asyncio.Semaphore(writers.queue_size))
+	return slot
+
+
+async def _submit(job, dev):
+	writer = writers.get_writer(dev)
+	async with _slot(dev):
+		try:
+			future = writer.submit(job, block=False)
+		except Full:
+			# the queue is also used by non-asyncio code, wait on a thread
+			loop = asyncio.get_running_loop()
+			future = await loop.run_in_executor(executor, writer.submit, job)
+		await asyncio.wrap_future(future)
+
+
+async def _run(job, dev, timeout):
+	await _run_jobs({_dev: job for _dev in lib27gn950._device_list(dev)}, timeout)
+
+
+async def _run_jobs(jobs, timeout):
+	# `jobs` maps each device to the job to run on it
+	tasks = [asyncio.ensure_future(_submit(job, dev)) for dev, job in jobs.items()]
+	try:
+		results = await asyncio.wait_for(asyncio.gather(*tasks, return_exceptions=True), timeout)
+	finally:
+		for task in tasks:
+			task.cancel()
+	for result in results:
+		if isinstance(result, BaseException):
+			raise result
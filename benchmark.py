@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the encode and write paths of lib27gn950
+#
+# No monitor is needed: writes go to FakeDevice, an in-memory stand-in for
+#   hid.Device that can simulate the time a USB write takes. The hid package
+#   still has to be importable, since lib27gn950 imports it.
+#
+# Usage:
+#   ./benchmark.py                        run everything, print a table
+#   ./benchmark.py --json results.json    also save the results as JSON
+#   ./benchmark.py --quick                shorter runs, for a quick check
+#   ./benchmark.py --help                 all options
+#
+# With --emulate, the simulated monitors are emulator.VirtualMonitor instead,
+#   which also decodes and validates everything that is written to them.
+#
+# Flow control (see flowcontrol.py) is turned off, as it would only measure
+#   the rate limit; --flow-control keeps it on.
+#
+# Every result has the benchmark name, its parameters, the number of
+#   operations, ops/sec, and the p50 / p99 / max latency of one operation in
+#   microseconds. Results from different versions can be compared by name and
+#   parameters.
+#
+# Benchmarks:
+#   calc_crc, crc8                CRC of a 150 byte video sync payload
+#   get_set_color_command         uncached (a different color every call)
+#   send_command                  one command to N devices (force=True, so the
+#                                 device state cache doesn't skip the writes)
+#   send_video_sync_data          hex string video sync frame to N devices
+#   send_video_sync_frame         NumPy video sync frame to N devices
+#   video_sync_sustained          send_video_sync_frame paced at 30 / 60 / 120
+#                                 fps to N devices, also reports achieved fps
+
+################################################################################
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import flowcontrol
+import lib27gn950
+import writers
+from crc8 import crc8
+
+
+class FakeDevice:
+	def __init__(self, serial='FAKE', latency=0.0):
+		self.serial = serial
+		self.model = 'benchmark'
+		self.latency = latency
+		self.writes = 0
+		self.bytes_written = 0
+
+	def write(self, data):
+		if self.latency:
+			time.sleep(self.latency)
+		self.writes += 1
+		self.bytes_written += len(data)
+		return len(data)
+
+	def read(self, size, timeout=None):
+		return b''
+
+	def close(self):
+		pass
+
+
+################################################################################
+################################################################################
+
+
+def percentile(sorted_values, fraction):
+	if not sorted_values:
+		return 0.0
+	index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+	return sorted_values[index]
+
+
+def summarize(name, params, latencies, elapsed, extra=None):
+	latencies = sorted(latencies)
+	result = {
+		'name': name,
+		'params': params,
+		'ops': len(latencies),
+		'ops_per_sec': len(latencies) / elapsed if elapsed > 0 else 0.0,
+		'p50_us': percentile(latencies, 0.50) * 1e6,
+		'p99_us': percentile(latencies, 0.99) * 1e6,
+		'max_us': latencies[-1] * 1e6 if latencies else 0.0,
+	}
+	if extra:
+		result.update(extra)
+	return result
+
+
+def measure(name, params, fn, duration):
+	# call fn() repeatedly for `duration` seconds, timing every call
+	clock = time.perf_counter
+	latencies = []
+	i = 0
+	start = clock()
+	end = start + duration
+	while True:
+		t0 = clock()
+		fn(i)
+		t1 = clock()
+		latencies.append(t1 - t0)
+		i += 1
+		if t1 >= end:
+			break
+	return summarize(name, params, latencies, clock() - start)
+
+
+def paced(name, params, fn, duration, fps):
+	# call fn() at `fps` calls per second, like a video sync stream would
+	clock = time.perf_counter
+	period = 1 / fps
+	latencies = []
+	late = 0
+	i = 0
+	start = clock()
+	deadline = start
+	first = last = start
+	while deadline - start < duration:
+		delay = deadline - clock()
+		if delay > 0:
+			time.sleep(delay)
+		t0 = clock()
+		fn(i)
+		t1 = clock()
+		latencies.append(t1 - t0)
+		if t1 > deadline + period:
+			late += 1
+		if i == 0:
+			first = t0
+		last = t0
+		i += 1
+		deadline += period
+	elapsed = clock() - start
+	return summarize(name, params, latencies, elapsed, {
+		'target_fps': fps,
+		# the rate at which frames were started
+		'achieved_fps': (i - 1) / (last - first) if last > first else 0.0,
+		'late_frames': late,
+	})
+
+
+################################################################################
+################################################################################
+
+
+def run(device_counts, duration, latency, rates, emulate=False, flow_control=False):
+	import numpy as np
+
+	if flow_control:
+		flowcontrol.enable()
+	else:
+		flowcontrol.disable()
+
+	if emulate:
+		import emulator
+		make_device = lambda i: emulator.VirtualMonitor(f'VIRTUAL{i}', latency=latency)
+	else:
+		make_device = lambda i: FakeDevice(f'FAKE{i}', latency)
+
+	results = []
+	payload = os.urandom(150)
+	payload_hex = payload.hex()
+
+	results.append(measure('calc_crc', {}, lambda i: lib27gn950.calc_crc(payload_hex), duration))
+	results.append(measure('crc8', {}, lambda i: crc8(payload), duration))
+
+	get_set_color_command = lib27gn950.get_set_color_command.__wrapped__
+	results.append(measure('get_set_color_command', {},
+		lambda i: get_set_color_command(i % 4 + 1, f'{i & 0xffffff:06x}'), duration))
+
+	rng = np.random.default_rng(0)
+	frames = rng.integers(0, 256, (64, 48, 3), dtype=np.uint8)
+	hex_frames = [[bytes(color).hex() for color in frame] for frame in frames]
+	cmd = lib27gn950.control_commands['color1']
+
+	for count in device_counts:
+		devs = [make_device(i) for i in range(count)]
+		params = {'devices': count, 'write_latency_us': latency * 1e6, 'emulate': int(emulate),
+			'flow_control': int(flow_control)}
+
+		results.append(measure('send_command', params,
+			lambda i: lib27gn950.send_command(cmd, devs, force=True), duration))
+		results.append(measure('send_video_sync_data', params,
+			lambda i: lib27gn950.send_video_sync_data(hex_frames[i % 64], devs, force=True), duration))
+		results.append(measure('send_video_sync_frame', params,
+			lambda i: lib27gn950.send_video_sync_frame(frames[i % 64], devs, force=True), duration))
+		for fps in rates:
+			results.append(paced('video_sync_sustained', dict(params, fps=fps),
+				lambda i: lib27gn950.send_video_sync_frame(frames[i % 64], devs, force=True), duration, fps))
+
+		for dev in devs:
+			writers.close_writer(dev)
+
+	return results
+
+
+def environment():
+	try:
+		version = subprocess.run(['git', 'describe', '--always', '--dirty'],
+			capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+	except OSError:
+		version = ''
+	return {
+		'version': version,
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+	}
+
+
+def print_table(results):
+	print(f'{"benchmark":24} {"params":40} {"ops/s":>12} {"p50 us":>10} {"p99 us":>10} {"fps":>8}')
+	for r in results:
+		params = ' '.join(f'{k}={v:g}' for k, v in r['params'].items())
+		fps = f'{r["achieved_fps"]:8.1f}' if 'achieved_fps' in r else ''
+		print(f'{r["name"]:24} {params:40} {r["ops_per_sec"]:12.0f} {r["p50_us"]:10.1f} {r["p99_us"]:10.1f} {fps}')
+
+
+################################################################################
+################################################################################
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark lib27gn950 without a monitor')
+	parser.add_argument('--devices', default='1,4,16',
+		help='comma-separated numbers of simulated monitors (default: 1,4,16)')
+	parser.add_argument('--duration', type=float, default=2.0,
+		help='seconds per benchmark (default: 2)')
+	parser.add_argument('--write-latency', type=float, default=0.0,
+		help='simulated time per USB write, in seconds (default: 0)')
+	parser.add_argument('--fps', default='30,60,120',
+		help='comma-separated video sync rates (default: 30,60,120)')
+	parser.add_argument('--emulate', action='store_true',
+		help='simulate monitors with emulator.VirtualMonitor, which validates every write')
+	parser.add_argument('--flow-control', action='store_true',
+		help='keep the write rate limits on')
+	parser.add_argument('--quick', action='store_true',
+		help='run each benchmark for 0.2 seconds')
+	parser.add_argument('--json', metavar='FILE',
+		help='write the results as JSON to FILE ("-" for stdout)')
+	args = parser.parse_args()
+
+	device_counts = [int(x) for x in args.devices.split(',')]
+	rates = [int(x) for x in args.fps.split(',')]
+	duration = 0.2 if args.quick else args.duration
+
+	results = run(device_counts, duration, args.write_latency, rates, args.emulate, args.flow_control)
+	output = {'environment': environment(), 'results': results}
+
+	if args.json == '-':
+		json.dump(output, sys.stdout, indent=2)
+		print()
+	else:
+		print_table(results)
+		if args.json:
+			with open(args.json, 'w') as f:
+				json.dump(output, f, indent=2)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# Per-monitor color calibration
+#
+# The same RGB value looks different on a 27GN950 and a 38GL950G, and the LEDs
+#   are far from linear at low values. A calibration Profile describes how to
+#   correct for that, and is compiled once into a lookup table of 256 output
+#   values per channel, so calibrating a color costs a table lookup:
+#   - video sync frames go through a single np.take over all 48 x 3 components
+#     (in lib27gn950.VideoSyncEncoder, replacing the minimum-of-1 clamp)
+#   - the colors of set color commands (get_set_color_command) are replaced
+#     as they are written, so the device state still holds the requested color
+#
+# Profiles are looked up by serial number first, then by model ('27GN950 /
+#   38GN950' or '38GL950G', as reported by lib27gn950.find_monitors()), and
+#   the result is cached per device. Devices without a profile are written to
+#   exactly as before.
+#
+# Pre-rendered sequences (sequence.py) are played back as recorded, without
+#   calibration.
+#
+#
+# calibration.ini, in the same directory as config.ini, is loaded by
+#   registry.default_registry(). One section per serial number or model:
+#
+#     [38GL950G]
+#     gamma = 1.8
+#     white = 1.0 0.85 0.9
+#
+#     [010NTNHNL976]
+#     gamma = 2.2
+#     floor = 4
+#
+#
+# API documentation:
+#
+# Profile(gamma=1.0, white=(1.0, 1.0, 1.0), floor=1)
+#   `gamma`   the output is 255 * (value / 255) ** gamma, so values above 1.0
+#             darken the low end, one number or one per channel
+#   `white`   a gain per channel (red, green, blue) for the white balance,
+#             from 0.0 to 1.0
+#   `floor`   the lowest value sent for every component. Always at least 1,
+#             as a component of 0 can 'crash' the monitor.
+#   identity  True if the profile changes nothing but the floor of 1
+#   lut       the (768,) uint8 NumPy array of the red, green and blue tables
+#   apply(colors)
+#     Return calibrated (48, 3) uint8 colors, given as for
+#       lib27gn950.send_video_sync_frame (requires NumPy)
+#   apply_bytes(data)
+#     The same, for RGB bytes, without NumPy
+#   color(color)
+#     Return a calibrated color string
+#
+#
+# profiles
+#   The dictionary of Profiles by serial number or model. Call clear_cache()
+#     after changing it directly.
+#
+# set_profile(key, profile)
+#   Set (or with None, remove) the profile for a serial number or model
+#
+# load(path=None)
+#   Add the profiles from an ini file, calibration.ini in the config directory
+#     by default. A missing file is not an error.
+#
+# device_profile(dev)
+#   Return the Profile used for a device, or None if it isn't calibrated
+#
+# device_groups(devs)
+#   Group devices by profile: None if no device is calibrated, otherwise a
+#     list of (profile or None, [devs])
+#
+# active
+#   True while any profile is set; the write path checks this first
+
+################################################################################
+
+import devconfig
+
+
+profiles = {}
+active = False
+
+
+################################################################################
+################################################################################
+
+
+class Profile:
+	def __init__(self, gamma=1.0, white=(1.0, 1.0, 1.0), floor=1):
+		if not hasattr(gamma, '__iter__'):
+			gamma = (gamma,) * 3
+		self.gamma = tuple(float(g) for g in gamma)
+		self.white = tuple(float(w) for w in white)
+		self.floor = max(1, min(255, int(floor)))
+		if len(self.gamma) != 3 or len(self.white) != 3:
+			raise ValueError('Profile: gamma and white must have one value per channel')
+		if min(self.gamma) <= 0 or not all(0.0 <= w <= 1.0 for w in self.white):
+			raise ValueError('Profile: gamma must be positive, and white from 0.0 to 1.0')
+
+		self.tables = tuple(
+			bytes(max(self.floor, round(255 * (value / 255) ** gamma * white)) for value in range(256))
+			for gamma, white in zip(self.gamma, self.white)
+		)
+		self.identity = self.tables == (bytes([1]) + bytes(range(1, 256)),) * 3
+		self._lut = None
+
+	def __repr__(self):
+		return f'<Profile gamma={self.gamma} white={self.white} floor={self.floor}>'
+
+	@property
+	def lut(self):
+		if self._lut is None:
+			import numpy as np
+			self._lut = np.frombuffer(b''.join(self.tables), dtype=np.uint8)
+		return self._lut
+
+	def apply(self, colors):
+		import numpy as np
+		colors = np.frombuffer(colors, dtype=np.uint8) if not isinstance(colors, np.ndarray) else colors
+		return np.take(self.lut, colors.reshape(-1) + channel_offsets()).reshape(48, 3)
+
+	def apply_bytes(self, data):
+		result = bytearray(data)
+		for channel, table in enumerate(self.tables):
+			result[channel::3] = result[channel::3].translate(table)
+		return bytes(result)
+
+	def color(self, color):
+		return self.apply_bytes(bytes.fromhex(color)).hex()
+
+
+_channel_offsets = None
+
+def channel_offsets():
+	# added to the 144 components of a frame to index the red, green and blue
+	#   tables of `lut`
+	global _channel_offsets
+	if _channel_offsets is None:
+		import numpy as np
+		_channel_offsets = np.tile(np.array([0, 256, 512], dtype=np.uint16), 48)
+	return _channel_offsets
+
+
+################################################################################
+################################################################################
+
+
+def clear_cache():
+	global active
+	_device_profiles.clear()
+	active = bool(profiles)
+
+def set_profile(key, profile):
+	if profile is None:
+		profiles.pop(key, None)
+	else:
+		profiles[key] = profile
+	clear_cache()
+
+def load(path=None):
+	if path is None:
+		path = devconfig.config_path('calibration.ini')
+	parser = devconfig.read_ini(path)
+	if parser is None:
+		return
+	for key in parser.sections():
+		section = parser[key]
+		params = {}
+		if 'gamma' in section:
+			gamma = [float(g) for g in section['gamma'].split()]
+			params['gamma'] = gamma[0] if len(gamma) == 1 else gamma
+		if 'white' in section:
+			params['white'] = [float(w) for w in section['white'].split()]
+		if 'floor' in section:
+			params['floor'] = section.getint('floor')
+		try:
+			profiles[key] = Profile(**params)
+		except ValueError as e:
+			raise ValueError(f'{path}: [{key}]: {e}') from None
+	clear_cache()
+
+
+def _lookup_profile(dev):
+	profile = devconfig.lookup(profiles, dev)
+	if profile is not None and profile.identity:
+		return None
+	return profile
+
+_device_profiles = devconfig.DeviceCache(_lookup_profile)
+
+def device_profile(dev):
+	return _device_profiles.get(dev)
+
+def device_groups(devs):
+	if not active:
+		return None
+	groups = {}
+	for dev in devs:
+		groups.setdefault(device_profile(dev), []).append(dev)
+	if list(groups) == [None]:
+		return None
+	return list(groups.items())
@@ -1,13 +1,22 @@
 #!/usr/bin/env python3
 
 import lib27gn950
-
-import hid
-# https://pypi.org/project/hid/
-# https://github.com/apmorton/pyhidapi
+import metrics
+import registry
 
 import re
 import sys
+import time
+from types import SimpleNamespace
+
+try:
+	import daemon
+	from daemon import DaemonError
+except ImportError:
+	# without the daemon, the monitors are always opened directly
+	daemon = None
+	class DaemonError(Exception):
+		pass
 
 
 
@@ -53,43 +62,140 @@ Valid commands:
   <128 character hex string>
     Send a raw command, entered as a 128-char hex string (representing 64 bytes)
 
-  Video sync is not supported in console mode
+  video_sync
+    Capture the screen and send it as video sync data until Ctrl-C is pressed,
+    then print timing statistics. Requires NumPy and Pillow.
+    Optional arguments: target frames per second (default 30), and "span" to
+    spread the screen across the selected monitors, left to right in the order
+    of `info`, with their frames written together so they change at once
+    Examples:
+      video_sync
+      video_sync 60
+      video_sync 60 span
+
+  effect
+    Run a lighting effect, computed on this computer and sent as video sync
+    data, until Ctrl-C is pressed. Requires NumPy.
+    Argument: the effect, one of rainbow, breathing, sweep, comet, fade
+    Optional arguments:
+      speed=N        animation speed (default 1.0)
+      brightness=N   0.0 to 1.0 (default 1.0)
+      color=C        a color to use, as a 6 character hex string. Can be
+                     repeated, for the effects that use several colors.
+      fps=N          frames per second (default 60)
+      seconds=N      stop after this many seconds
+    Examples:
+      effect rainbow
+      effect breathing color=ff2b83 speed=0.5
+      effect sweep color=ff0000 color=0000ff brightness=0.5
+
+  render   record   play
+    Save lighting to a sequence file, and play it back. Playback needs neither
+    NumPy nor much CPU, as the file contains the ready-to-send data.
+      render FILE EFFECT [options]
+        Render an effect to FILE. The options are the same as for "effect",
+        seconds defaults to 60.
+      record FILE [fps]
+        Run video sync (as the "video_sync" command does), and record it to
+        FILE
+      play FILE [loop]
+        Play FILE, and keep repeating it if "loop" is given
+    Examples:
+      render rainbow.seq rainbow seconds=600 speed=0.5
+      play rainbow.seq loop
+
+  scene
+    Named lighting setups: the power, mode, brightness and static colors of
+    the selected monitors. Applying a scene only sends what differs from what
+    the monitors are known to show. The GUI and the daemon restore the last
+    scene applied when they start.
+      scene               list the saved scenes
+      scene NAME          apply a scene
+      scene save NAME     save what the selected monitors show as a scene
+      scene delete NAME
+    Examples:
+      scene save focus
+      scene meeting
+
+  stats
+    Show how many commands and bytes have been written to each monitor, write
+    errors, and write latency, since the program started
+    "stats reset" clears them
+
+
+Batch mode:
+
+  console.py --batch [FILE]
+    Read commands from FILE (or from standard input if FILE is "-" or
+    missing), one per line, and send them as fast as possible, or as timed
+    by these directives:
+      sleep SECONDS   wait this long before the next command
+      at SECONDS      wait until this many seconds after the start
+    Every line is checked before anything is sent. The monitors are opened
+    once, and the throughput is printed at the end. Lines starting with # are
+    ignored. Example:
+      select 1
+      set 1 ff0000
+      color1
+      sleep 0.5
+      select all
+      12
 '''
 
 
 devs = []
 selected = []
+# set when the commands are sent through a running daemon (see daemon.py)
+daemon_client = None
 
 
-def setup():
-	global selected
-	monitors = lib27gn950.find_monitors()
-	if not monitors:
+def setup(use_daemon=False):
+	global selected, daemon_client
+	if use_daemon and daemon is not None:
+		daemon_client = daemon.connect()
+	if daemon_client is not None:
+		devs.extend(SimpleNamespace(**monitor) for monitor in daemon_client.info())
+	else:
+		devs.extend(registry.default_registry().devices())
+	if not devs:
 		print('No monitors found')
 		sys.exit(0)
-	for monitor in monitors:
-		dev = hid.Device(path=monitor['path'])
-		dev.model = monitor['model']
-		devs.append(dev)
 	selected = list(range(len(devs)))
 
 
 def cleanup():
-	for dev in devs:
-		dev.close()
+	if daemon_client is not None:
+		daemon_client.close()
+	else:
+		registry.default_registry().close()
 
 
 def get_selected_devs():
 	result = []
 	for x in selected:
-		result.append(devs[x])
+		if devs[x].connected:
+			result.append(devs[x])
 	return result
 
+
+def send_command(cmd):
+	if daemon_client is not None:
+		daemon_client.send_command(cmd, [dev.serial for dev in get_selected_devs()])
+	else:
+		lib27gn950.send_command(cmd, get_selected_devs())
+
+
+def send_raw_command(cmd):
+	if daemon_client is not None:
+		daemon_client.send_raw_command(cmd, [dev.serial for dev in get_selected_devs()])
+	else:
+		lib27gn950.send_raw_command(cmd, get_selected_devs())
+
 	
 def cli():
 	while True:
 		try:
-			text = input(': ').lower().strip()
+			text = input(': ').strip()
 			cli_process_line(text)
 		except KeyboardInterrupt as e:
 			print()
@@ -102,14 +208,14 @@ def cli():
 def noninteractive():
 	global selected
 
-	cmd = ' '.join([x.lower() for x in sys.argv[1:]]).strip()
+	cmd = ' '.join(sys.argv[1:]).strip()
 	selection = []
 
 	try:
 		if ',' in cmd:
 			parts = [x for x in cmd.split(',') if (x != '' and not x.isspace())]
 			cmd = parts[-1]
-			selection = parts[:-1]
+			selection = [x.lower() for x in parts[:-1]]
 		if selection and not ('all' in selection): # default selection is all
 			selected = [int(num)-1 for num in selection]
 			selected = [x for x in selected if x >= 0 and x < len(devs)]
@@ -124,8 +230,168 @@ def noninteractive():
 	cli_process_line(cmd)
 
 
-def cli_process_line(text):
+def video_sync(fps, record=None, span=False):
+	import videosync
+	if daemon_client is not None:
+		print('Video sync is not available while the daemon is running')
+		return
+	if fps < 1:
+		print('Frames per second must be at least 1')
+		return
+	devs = get_selected_devs()
+	if record is not None:
+		import sequence
+		recorder = sequence.Recorder(record)
+		devs.append(recorder)
+	pipeline = videosync.VideoSync(videosync.ScreenSource(all_screens=span), devs, fps, span=span)
+	print('Running video sync, press Ctrl-C to stop')
+	try:
+		pipeline.run()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		if record is not None:
+			recorder.close()
+	stats = pipeline.stats()
+	print()
+	print(f'Sent {stats["frames"]} frames at {stats["fps"]:.1f} fps (target {fps})')
+	print(f'  dropped {stats["dropped"]}, paced at {stats["effective_fps"]:.1f} fps, jitter {stats["jitter_ms"]:.2f} ms')
+	for stage in pipeline.stages:
+		print(f'  {stage:8} mean {stats[stage]["mean_ms"]:7.2f} ms   max {stats[stage]["max_ms"]:7.2f} ms')
+	if span:
+		print(f'  {"skew":8} mean {stats["skew"]["mean_ms"]:7.2f} ms   max {stats["skew"]["max_ms"]:7.2f} ms')
+	if record is not None:
+		print(f'Recorded {recorder.frames} frames to {record}')
+	print()
+
+
+def parse_effect_options(name, options, settings):
+	# returns the effect, and updates `settings` (fps, seconds...) in place
+	import effects
+	params = {}
+	for option in options:
+		key, value = option.split('=')
+		if key == 'color':
+			if not re.match(r'^[0-9a-f]{6}$', value):
+				raise ValueError
+			params.setdefault('palette', []).append(value)
+		elif key in ['speed', 'brightness']:
+			params[key] = float(value)
+		elif key in settings:
+			settings[key] = int(value)
+		else:
+			raise ValueError
+	if settings['fps'] < 1:
+		raise ValueError('Frames per second must be at least 1')
+	return effects.create(name, **params)
+
+
+def effect(name, options):
+	import effects
+	if daemon_client is not None:
+		print('Effects are not available while the daemon is running')
+		return
+	settings = {'fps': 60, 'seconds': None}
+	try:
+		pipeline = effects.pipeline(parse_effect_options(name, options, settings), get_selected_devs(), settings['fps'])
+	except ValueError as e:
+		print(str(e) or 'Invalid effect options. Enter "help" for help.')
+		print()
+		return
+	print(f'Running the {name} effect, press Ctrl-C to stop')
+	try:
+		seconds = settings['seconds']
+		pipeline.run(seconds * settings['fps'] if seconds else None)
+	except KeyboardInterrupt:
+		pass
+	print()
+
+
+def render(path, name, options):
+	import sequence
+	settings = {'fps': 60, 'seconds': 60}
+	try:
+		effect = parse_effect_options(name, options, settings)
+	except ValueError as e:
+		print(str(e) or 'Invalid effect options. Enter "help" for help.')
+		print()
+		return
+	fps = settings['fps']
+	count = settings['seconds'] * fps
+	sequence.render(path, (effect.render(i / fps) for i in range(count)), fps)
+	print(f'Rendered {count} frames to {path}')
+	print()
+
+
+def play(path, loop):
+	import sequence
+	if daemon_client is not None:
+		print('Playback is not available while the daemon is running')
+		return
+	try:
+		seq = sequence.Sequence(path)
+	except (OSError, ValueError) as e:
+		print(e)
+		print()
+		return
+	with seq:
+		player = sequence.Player(seq, get_selected_devs(), loop)
+		print(f'Playing {len(seq)} frames ({seq.duration:.1f} s), press Ctrl-C to stop')
+		try:
+			player.run()
+		except KeyboardInterrupt:
+			pass
+		stats = player.stats()
+		print(f'Sent {stats["frames"]} frames, skipped {stats["skipped"]}')
+	print()
+
+
+def scene(args):
+	import scenes
+	if not args:
+		names = daemon_client.scenes() if daemon_client is not None else scenes.names()
+		print(', '.join(names) if names else 'No scenes saved')
+	elif args[0] == 'save' and len(args) == 2:
+		if daemon_client is not None:
+			daemon_client.save_scene(args[1], [dev.serial for dev in get_selected_devs()])
+		else:
+			saved = scenes.save(args[1], get_selected_devs())
+			if not any(state['power'] is not None or state['brightness'] is not None or any(state['colors']) for state in saved.values()):
+				print('Nothing has been sent to the selected monitors yet, so their state is unknown')
+	elif args[0] == 'delete' and len(args) == 2:
+		scenes.delete(args[1])
+	elif len(args) == 1:
+		if daemon_client is not None:
+			count = daemon_client.apply_scene(args[0], [dev.serial for dev in get_selected_devs()])
+		else:
+			count = sum(len(cmds) for cmds in scenes.apply(args[0], get_selected_devs()).values())
+		print(f'Sent {count} command' + ('' if count == 1 else 's'))
+	else:
+		print('Usage: scene [NAME | save NAME | delete NAME]')
+	print()
+
+
+def print_stats():
+	snapshot = daemon_client.stats() if daemon_client is not None else metrics.snapshot()
+	if not snapshot['devices']:
+		print('Nothing has been written yet')
+	for name, m in snapshot['devices'].items():
+		print(f'{name}:')
+		print(f'  commands {m["commands"]} (video sync frames {m["video_sync_frames"]}), skipped {m["skipped"]}')
+		print(f'  reports {m["reports"]}, bytes {m["bytes"]}, errors {m["errors"]}')
+		print(f'  latency p50 {m["latency_p50_ms"]:.2f} ms, p99 {m["latency_p99_ms"]:.2f} ms')
+		flow = m.get('flow')
+		if flow is not None:
+			print(f'  rate limit {flow["rate"]:.0f} reports/s ({flow["policy"]}), waited {flow["blocked"]} times ({flow["blocked_time"] * 1000:.0f} ms),'
+				+ f' dropped {flow["dropped"]}, coalesced {flow["coalesced"]}', end='')
+			print(f', round trip {flow["rtt_ms"]:.2f} ms' if flow['rtt_ms'] is not None else '')
+	print()
+
+
+def cli_process_line(line):
 	global selected
+	# file names are the only arguments that aren't case insensitive
+	text = line.lower()
 
 	if text in ['exit', 'quit', 'q']:
 		sys.exit(0)
@@ -134,13 +400,13 @@ def cli_process_line(text):
 		print(help_text)
 
 	elif text in lib27gn950.control_commands.keys():
-		lib27gn950.send_command(lib27gn950.control_commands[text], get_selected_devs())
+		send_command(lib27gn950.control_commands[text])
 
 	elif text in [str(x) for x in range(1, 13)]:
-		lib27gn950.send_command(lib27gn950.brightness_commands[int(text)], get_selected_devs())
+		send_command(lib27gn950.brightness_commands[int(text)])
 
 	elif len(text) == 128:
-		lib27gn950.send_raw_command(text, get_selected_devs())
+		send_raw_command(text)
 
 	elif text == 'select' or re.match(r'select +all', text):
 		selected = list(range(len(devs)))
@@ -155,7 +421,47 @@ def cli_process_line(text):
 		parts = text.split()
 		slot = int(parts[1])
 		color = parts[2]
-		lib27gn950.send_command(lib27gn950.get_set_color_command(slot, color), get_selected_devs())
+		send_command(lib27gn950.get_set_color_command(slot, color))
+
+	elif re.match(r'^video_sync( +\d+)?( +span)?$', text):
+		parts = text.split()
+		span = parts[-1] == 'span'
+		if span:
+			parts.pop()
+		fps = int(parts[1]) if len(parts) > 1 else 30
+		video_sync(fps, span=span)
+
+	elif re.match(r'^record +\S+( +\d+)?$', text):
+		parts = text.split()
+		video_sync(int(parts[2]) if len(parts) > 2 else 30, line.split()[1])
+
+	elif re.match(r'^render +\S+ +\w+( +\S+)*$', text):
+		parts = text.split()
+		render(line.split()[1], parts[2], parts[3:])
+
+	elif re.match(r'^play +\S+( +loop)?$', text):
+		parts = text.split()
+		play(line.split()[1], len(parts) > 2)
+
+	elif re.match(r'^effect +\w+( +\S+)*$', text):
+		parts = text.split()
+		effect(parts[1], parts[2:])
+
+	elif re.match(r'^scene( +\S+){0,2}$', text):
+		try:
+			scene(text.split()[1:])
+		except (ValueError, DaemonError) as e:
+			print(e)
+			print()
+
+	elif text == 'stats':
+		print_stats()
+
+	elif text == 'stats reset':
+		if daemon_client is not None:
+			daemon_client.reset_stats()
+		else:
+			metrics.reset()
 
 	elif text in ['info']:
 		if not devs:
@@ -166,7 +472,8 @@ def cli_process_line(text):
 			print()
 			for i in range(len(devs)):
 				print(f'{"* " if i in selected else "  "}', end='')
-				print(f'{i+1}: serial: {devs[i].serial}, model: {devs[i].model}')
+				print(f'{i+1}: serial: {devs[i].serial}, model: {devs[i].model}', end='')
+				print('' if devs[i].connected else ' (disconnected)')
 		print()
 
 	else:
@@ -174,16 +481,92 @@ def cli_process_line(text):
 		print()
 
 
+def parse_batch_line(text):
+	# returns (action, argument), with commands already compiled
+	if text in lib27gn950.control_commands.keys():
+		return 'send', lib27gn950.control_frames[text]
+	if text in [str(x) for x in range(1, 13)]:
+		return 'send', lib27gn950.brightness_frames[int(text)]
+	if len(text) == 128 and re.match(r'^[0-9a-f]+$', text):
+		return 'send', lib27gn950.compile_raw_command(text)
+	if re.match(r'^set [1-4] [0-9a-f]{6}$', text):
+		parts = text.split()
+		return 'send', lib27gn950.compile_command(lib27gn950.get_set_color_command(int(parts[1]), parts[2]))
+	if text == 'select' or re.match(r'^select +all$', text):
+		return 'select', list(range(len(devs)))
+	if re.match(r'^select( +\d+)+$', text):
+		selection = [int(num)-1 for num in text.split()[1:]]
+		return 'select', [x for x in selection if x >= 0 and x < len(devs)]
+	match = re.match(r'^(sleep|at) +(\d+(\.\d*)?|\.\d+)$', text)
+	if match:
+		return match[1], float(match[2])
+	raise ValueError(f'command not recognized: {text}')
+
+
+def batch(path):
+	global selected
+
+	lines = sys.stdin if path in [None, '-'] else open(path)
+	actions = []
+	errors = 0
+	with lines:
+		for number, line in enumerate(lines, 1):
+			text = line.lower().strip()
+			if not text or text.startswith('#'):
+				continue
+			try:
+				actions.append(parse_batch_line(text))
+			except ValueError as e:
+				print(f'line {number}: {e}', file=sys.stderr)
+				errors += 1
+	if errors:
+		sys.exit(1)
+
+	clock = time.perf_counter
+	sent = 0
+	start = clock()
+	deadline = start
+	for action, argument in actions:
+		if action == 'send':
+			delay = deadline - clock()
+			if delay > 0:
+				time.sleep(delay)
+			lib27gn950.send_frames(argument, get_selected_devs())
+			sent += 1
+		elif action == 'select':
+			selected = argument
+		elif action == 'sleep':
+			# relative to when the previous command was due, so delays don't add up
+			deadline += argument
+		elif action == 'at':
+			deadline = start + argument
+	elapsed = clock() - start
+
+	rate = sent / elapsed if elapsed > 0 else 0.0
+	print(f'Sent {sent} commands in {elapsed:.3f} s ({rate:.0f} commands/s)', file=sys.stderr)
+
+
 if __name__ == '__main__':
 	if len(sys.argv) > 1 and sys.argv[1] in ['-h', '--help', 'h', 'help', '?']:
 		print(help_text)
 		sys.exit(0)
+	if len(sys.argv) > 1 and sys.argv[1] == '--batch':
+		try:
+			setup()
+			batch(sys.argv[2] if len(sys.argv) > 2 else None)
+		finally:
+			cleanup()
+		sys.exit(0)
 	try:
-		setup()
+		# scripted commands go through the daemon if it's running, as it
+		#   already has the monitors open
+		setup(use_daemon=len(sys.argv) > 1)
 		if len(sys.argv) > 1:
 			noninteractive()
 		else:
 			print(f'Connected to {len(devs)} monitors')
+			registry.default_registry().start_polling()
+			metrics.enable()
 			cli()
 	finally:
 		cleanup()
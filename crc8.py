@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+# CRC used by the 27GN950 / 38GN950 / 38GL950G HID protocol
+#
+# This is the standard table-driven CRC-8 algorithm, with the polynomial set to
+#   what the monitors use (0x01, no reflection, no final xor). It produces the
+#   same results as the bit-by-bit implementation that lib27gn950 used to have.
+#
+#
+# API documentation:
+#
+# crc8(data, crc=0)
+#   Return the CRC of `data` as an integer in the range [0..255]
+#   `data` must be a bytes-like object (bytes, bytearray, memoryview, ...)
+#   `crc` is the starting value, which can be used to continue a previous
+#     calculation: crc8(a + b) == crc8(b, crc8(a))
+#
+#
+# Crc8(data=b'')
+#   Incremental form of crc8, in the style of hashlib. Useful for hashing a
+#     fixed header once and reusing it for many commands:
+#       header = Crc8(bytes.fromhex('5343c1029100'))
+#       crc = header.copy().update(colors).digest()
+#   update(data)   add more data, returns the object so calls can be chained
+#   copy()         return an independent copy of the current state
+#   digest()       return the CRC as an integer
+#   hexdigest()    return the CRC as a 2-character lowercase hex string
+#
+#
+# crc8_batch(frames, crc=0)
+#   Return the CRCs of many equal-length frames at once, as a uint8 NumPy
+#     array. `frames` must be convertible to a 2D uint8 array of shape
+#     (number of frames, frame length). Requires NumPy.
+#   `crc` is the starting value for every frame, e.g. Crc8(header).digest()
+
+################################################################################
+
+
+def _make_table():
+	table = bytearray(256)
+	for i in range(256):
+		crc = i
+		for _ in range(8):
+			crc <<= 1
+			if crc & 0x100:
+				crc ^= 0x101
+		table[i] = crc
+	return bytes(table)
+
+TABLE = _make_table()
+
+
+################################################################################
+
+def crc8(data, crc=0):
+	table = TABLE
+	for byte in memoryview(data).cast('B'):
+		crc = table[crc ^ byte]
+	return crc
+
+################################################################################
+
+class Crc8:
+	def __init__(self, data=b''):
+		self.crc = crc8(data) if len(data) else 0
+
+	def update(self, data):
+		self.crc = crc8(data, self.crc)
+		return self
+
+	def copy(self):
+		other = Crc8()
+		other.crc = self.crc
+		return other
+
+	def digest(self):
+		return self.crc
+
+	def hexdigest(self):
+		return f'{self.crc:02x}'
+
+################################################################################
+
+def crc8_batch(frames, crc=0):
+	import numpy as np
+
+	frames = np.asarray(frames, dtype=np.uint8)
+	if frames.ndim != 2:
+		raise ValueError('crc8_batch: frames must be a 2D array of shape (n, length)')
+
+	table = np.frombuffer(TABLE, dtype=np.uint8)
+	crcs = np.full(frames.shape[0], crc, dtype=np.uint8)
+	# one table lookup per byte column, across every frame at once
+	for column in frames.T:
+		crcs = table[crcs ^ column]
+	return crcs
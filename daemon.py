@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+
+# Control daemon
+#
+# Opening the monitors is the slow part of a short-lived program like
+#   `console.py 2,color3`: enumerating every HID device and opening the
+#   monitors takes far longer than sending the command. The daemon keeps the
+#   monitors open (through registry.py) and accepts commands over a Unix
+#   domain socket, so such a program only has to connect to it. (console.py
+#   still imports lib27gn950, and with it hid, as it needs them when no daemon
+#   is running.)
+#
+# console.py uses the daemon automatically for non-interactive commands when
+#   it is running, and opens the monitors itself otherwise. The GUI runs the
+#   daemon in its own process if `daemon=True` is set in config.ini.
+#
+# Usage:
+#   ./daemon.py                    run in the foreground until Ctrl-C, after
+#                                  restoring the last scene (see scenes.py)
+#   ./daemon.py --socket PATH      use a different socket
+#
+#
+# Protocol:
+#   Requests and responses are single-line JSON objects, one response per
+#   request, and a connection can be used for any number of requests.
+#   Every request has an "op", and every response has "ok" (true or false)
+#   and, if "ok" is false, an "error" message.
+#     {"op": "ping"}
+#     {"op": "info"}
+#       -> "monitors": [{"serial": ..., "model": ..., "connected": ...}, ...]
+#     {"op": "command", "cmd": <cmd>, "serials": [...], "force": false}
+#       send_command(cmd, ...), `cmd` being a string or a list of strings
+#     {"op": "raw", "cmd": <128 character hex string>, "serials": [...]}
+#       send_raw_command(cmd, ...)
+#     {"op": "stats"}
+#       -> "stats": metrics.snapshot()
+#     {"op": "reset_stats"}
+#       metrics.reset()
+#     {"op": "scenes"}
+#       -> "scenes": [names]
+#     {"op": "scene", "name": <name>, "serials": [...]}
+#       scenes.apply(), against the state the daemon knows the monitors are in
+#       -> "commands": the number of commands sent
+#     {"op": "save_scene", "name": <name>, "serials": [...]}
+#       scenes.save()
+#   "serials" selects the monitors, all connected monitors if it is missing
+#     or null.
+#
+#
+# API documentation:
+#
+# socket_path()
+#   The default socket path: $LIB27GN950_SOCKET if set, otherwise
+#     27gn950.sock in $XDG_RUNTIME_DIR, or in the temporary directory
+#
+# Daemon(registry=None, path=None)
+#   `registry` defaults to registry.default_registry()
+#   listen()          Bind the socket and open the monitors, raising
+#                     DaemonError if another daemon is already listening
+#   start()           Serve on a background thread
+#   serve_forever()   Serve on the current thread
+#   (start() and serve_forever() call listen() first if it hasn't been)
+#   close()           Stop listening and remove the socket
+#
+# connect(path=None, timeout=5.0)
+#   Return a Client connected to the daemon, or None if it isn't running
+#
+# Client
+#   request(op, **args)   Send a request and return the response, raising
+#                         DaemonError if it wasn't ok
+#   info()                The list of monitors
+#   send_command(cmd, serials=None, force=False)
+#   send_raw_command(cmd, serials=None, force=False)
+#   stats()
+#   reset_stats()
+#   scenes()
+#   apply_scene(name, serials=None)   Return the number of commands sent
+#   save_scene(name, serials=None)
+#   close()
+
+################################################################################
+
+import json
+import os
+import socket
+import socketserver
+import sys
+import tempfile
+from threading import Thread
+
+import lib27gn950
+import metrics
+import scenes
+from registry import default_registry
+
+
+class DaemonError(Exception):
+	pass
+
+
+def socket_path():
+	if os.environ.get('LIB27GN950_SOCKET'):
+		return os.environ['LIB27GN950_SOCKET']
+	directory = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+	return os.path.join(directory, '27gn950.sock')
+
+
+################################################################################
+################################################################################
+
+
+class _Handler(socketserver.StreamRequestHandler):
+	def handle(self):
+		for line in self.rfile:
+			try:
+				request = json.loads(line)
+				response = self.server.daemon.handle(request)
+				response['ok'] = True
+			except Exception as e:
+				response = {'ok': False, 'error': str(e) or type(e).__name__}
+			self.wfile.write(json.dumps(response).encode() + b'\n')
+
+
+if hasattr(socket, 'AF_UNIX'):
+	class _Server(socketserver.ThreadingUnixStreamServer):
+		daemon_threads = True
+else:
+	# e.g. on Windows: there is never a daemon to connect to, and none can run
+	_Server = None
+
+
+class Daemon:
+	def __init__(self, registry=None, path=None):
+		self.registry = registry or default_registry()
+		self.path = path or socket_path()
+		self.server = None
+
+	def listen(self):
+		if _Server is None:
+			raise DaemonError('the daemon needs Unix domain sockets, which this platform does not have')
+		if os.path.exists(self.path):
+			client = connect(self.path)
+			if client is not None:
+				client.close()
+				raise DaemonError(f'a daemon is already listening on {self.path}')
+			# left behind by a daemon that didn't exit cleanly
+			os.unlink(self.path)
+		self.server = _Server(self.path, _Handler)
+		self.server.daemon = self
+		os.chmod(self.path, 0o600)
+		self.registry.devices()
+		self.registry.start_polling()
+		metrics.enable()
+
+	def start(self):
+		if self.server is None:
+			self.listen()
+		Thread(target=self.server.serve_forever, name='daemon', daemon=True).start()
+
+	def serve_forever(self):
+		if self.server is None:
+			self.listen()
+		self.server.serve_forever()
+
+	def close(self):
+		if self.server is not None:
+			self.server.shutdown()
+			self.server.server_close()
+			self.server = None
+			try:
+				os.unlink(self.path)
+			except FileNotFoundError:
+				pass
+
+	############################################################################
+
+	def devices(self, serials):
+		devs = self.registry.devices()
+		if serials is None:
+			return devs
+		by_serial = {dev.serial: dev for dev in devs}
+		for serial in serials:
+			if serial not in by_serial:
+				raise DaemonError(f'no connected monitor with serial {serial!r}')
+		return [by_serial[serial] for serial in serials]
+
+	def handle(self, request):
+		op = request.get('op')
+		if op == 'ping':
+			return {}
+		if op == 'info':
+			return {'monitors': [
+				{'serial': dev.serial, 'model': dev.model, 'connected': dev.connected}
+				for dev in self.registry.devices()
+			]}
+		if op == 'command':
+			cmd = request['cmd']
+			if type(cmd) == list:
+				cmd = tuple(cmd)
+			lib27gn950.send_command(cmd, self.devices(request.get('serials')), request.get('force', False))
+			return {}
+		if op == 'raw':
+			lib27gn950.send_raw_command(request['cmd'], self.devices(request.get('serials')), request.get('force', False))
+			return {}
+		if op == 'stats':
+			return {'stats': metrics.snapshot()}
+		if op == 'reset_stats':
+			metrics.reset()
+			return {}
+		if op == 'scenes':
+			return {'scenes': scenes.names()}
+		if op == 'scene':
+			plan = scenes.apply(request['name'], self.devices(request.get('serials')))
+			return {'commands': sum(len(cmds) for cmds in plan.values())}
+		if op == 'save_scene':
+			scenes.save(request['name'], self.devices(request.get('serials')))
+			return {}
+		raise DaemonError(f'unknown op {op!r}')
+
+
+################################################################################
+################################################################################
+
+
+class Client:
+	def __init__(self, sock):
+		self.sock = sock
+		self.file = sock.makefile('rwb')
+
+	def request(self, op, **args):
+		self.file.write(json.dumps(dict(args, op=op)).encode() + b'\n')
+		self.file.flush()
+		line = self.file.readline()
+		if not line:
+			raise DaemonError('the daemon closed the connection')
+		response = json.loads(line)
+		if not response['ok']:
+			raise DaemonError(response['error'])
+		return response
+
+	def info(self):
+		return self.request('info')['monitors']
+
+	def send_command(self, cmd, serials=None, force=False):
+		if type(cmd) != str:
+			cmd = list(cmd)
+		self.request('command', cmd=cmd, serials=serials, force=force)
+
+	def send_raw_command(self, cmd, serials=None, force=False):
+		self.request('raw', cmd=cmd, serials=serials, force=force)
+
+	def stats(self):
+		return self.request('stats')['stats']
+
+	def reset_stats(self):
+		self.request('reset_stats')
+
+	def scenes(self):
+		return self.request('scenes')['scenes']
+
+	def apply_scene(self, name, serials=None):
+		return self.request('scene', name=name, serials=serials)['commands']
+
+	def save_scene(self, name, serials=None):
+		self.request('save_scene', name=name, serials=serials)
+
+	def close(self):
+		self.file.close()
+		self.sock.close()
+
+
+def connect(path=None, timeout=5.0):
+	if not hasattr(socket, 'AF_UNIX'):
+		return None
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	sock.settimeout(timeout)
+	try:
+		sock.connect(path or socket_path())
+	except OSError:
+		sock.close()
+		return None
+	return Client(sock)
+
+
+################################################################################
+################################################################################
+
+if __name__ == '__main__':
+	import argparse
+
+	parser = argparse.ArgumentParser(description='Keep the monitors open and accept commands on a Unix socket')
+	parser.add_argument('--socket', metavar='PATH', help=f'socket path (default: {socket_path()})')
+	args = parser.parse_args()
+
+	daemon = Daemon(path=args.socket)
+	try:
+		# only once the socket is bound, so that a second daemon fails
+		#   before it touches the monitors
+		daemon.listen()
+		scenes.restore(daemon.registry.devices())
+		print(f'Listening on {daemon.path}')
+		daemon.serve_forever()
+	except KeyboardInterrupt:
+		print()
+	except DaemonError as e:
+		print(e, file=sys.stderr)
+		sys.exit(1)
+	finally:
+		daemon.close()
+		daemon.registry.close()
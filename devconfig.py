@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+# Per-device settings
+#
+# Color calibration (calibration.py) and flow control (flowcontrol.py) both
+#   keep settings per serial number or model, read from an ini file in the
+#   config directory, and resolved once per device. This module has the parts
+#   they share. Scenes (scenes.py) keep their file in the same directory.
+#
+#
+# API documentation:
+#
+# config_path(name)
+#   The path of the file `name` in the directory of config.ini
+#
+# read_ini(path)
+#   Return a configparser.ConfigParser with the file read, or None if it
+#     doesn't exist
+#
+# lookup(table, dev, default=None)
+#   Return the value for a device from a dictionary keyed by serial number or
+#     model, the serial number taking precedence, or `default`
+#
+# DeviceCache(create)
+#   A value per device, computed by create(dev) when it is first needed and
+#     kept for as long as the device object lives
+#   get(dev)      the value, computing it if needed
+#   cached(dev)   the value if it has been computed, otherwise None
+#   clear()       forget all values, e.g. after the settings changed
+
+################################################################################
+
+import configparser
+from threading import Lock
+from weakref import WeakKeyDictionary
+
+
+def config_path(name):
+	# helpers needs Python 3.10, the rest of the library doesn't
+	import helpers
+	return helpers.config_dir() / name
+
+def read_ini(path):
+	parser = configparser.ConfigParser()
+	if not parser.read(path):
+		return None
+	return parser
+
+
+def lookup(table, dev, default=None):
+	for key in (getattr(dev, 'serial', None), getattr(dev, 'model', None)):
+		if key in table:
+			return table[key]
+	return default
+
+
+################################################################################
+
+_missing = object()
+
+class DeviceCache:
+	def __init__(self, create):
+		self.create = create
+		self.values = WeakKeyDictionary()
+		self.lock = Lock()
+
+	def get(self, dev):
+		value = self.values.get(dev, _missing)
+		if value is _missing:
+			value = self.create(dev)
+			with self.lock:
+				# another thread may have been first
+				value = self.values.setdefault(dev, value)
+		return value
+
+	def cached(self, dev):
+		return self.values.get(dev)
+
+	def clear(self):
+		with self.lock:
+			self.values.clear()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+# Software lighting effects
+#
+# The monitor's own animated modes are color_peaceful and color_dynamic. The
+#   effects here are computed on the host instead, and sent to the monitor as
+#   video sync frames. Every effect computes all 48 zones at once with NumPy
+#   array operations, so a frame takes a few microseconds to render.
+#
+# Zones are numbered clockwise around the monitor (see zones.py), so an effect
+#   that moves along the zones goes around the monitor.
+#
+# Requires NumPy.
+#
+#
+# API documentation:
+#
+# Every effect takes the parameters:
+#   speed        how fast it animates, 1.0 being the default
+#   brightness   from 0.0 to 1.0, scales every color
+#   palette      a list of color strings, e.g. ['ff0000', '0000ff']. Effects
+#                that don't take a list use the first color.
+#
+#   Rainbow        hues cycling around the monitor
+#   Breathing      the first color, fading in and out
+#   GradientSweep  a gradient through the palette, moving around the monitor
+#   Comet          a bright head with a fading tail, going around the monitor
+#   Fade           the whole monitor in one color, fading from one palette
+#                  color to the next
+#
+#   effect.render(t)
+#     Return the (48, 3) uint8 colors at `t` seconds. The array is reused by
+#       the next call.
+#
+#
+# effects
+#   A dictionary of the effect classes by name: rainbow, breathing, sweep,
+#     comet, fade
+#
+# create(name, **params)
+#   Create an effect by name
+#
+# pipeline(effect, devs, fps=60)
+#   Return a videosync.VideoSync pipeline that sends the effect to the
+#     device(s), and takes care of the timing. Like any VideoSync, run() it on
+#     the current thread, or start() and stop() it. The monitors are switched
+#     to video sync mode when it starts.
+#
+# play(effect, devs, fps=60)
+#   Start a pipeline() on a background thread and return it
+#
+# EffectSource(effect)
+#   A videosync.FrameSource returning the frames of an effect
+
+################################################################################
+
+import time
+
+import numpy as np
+
+import videosync
+from zones import zone_count
+
+
+default_palette = ['ff0000', 'ffff00', '00ff00', '00ffff', '0000ff', 'ff00ff']
+
+
+def palette_array(palette):
+	return np.array([tuple(bytes.fromhex(color)) for color in palette], dtype=np.float32)
+
+
+################################################################################
+################################################################################
+
+
+class Effect:
+	def __init__(self, speed=1.0, brightness=1.0, palette=None):
+		self.speed = speed
+		self.brightness = brightness
+		self.palette = palette_array(palette or default_palette)
+		# position of every zone along the strip, from 0 to 1
+		self.position = np.arange(zone_count, dtype=np.float32) / zone_count
+		self.rgb = np.empty((zone_count, 3), dtype=np.float32)
+		self.frame = np.empty((zone_count, 3), dtype=np.uint8)
+
+	def render(self, t):
+		self.draw(t * self.speed)
+		self.rgb *= self.brightness
+		np.clip(self.rgb, 0, 255, out=self.rgb)
+		self.frame[:] = self.rgb
+		return self.frame
+
+	def draw(self, t):
+		# fill self.rgb with colors in the range [0, 255]
+		raise NotImplementedError
+
+
+class Rainbow(Effect):
+	# HSV to RGB with full saturation and value: the green and blue channels
+	#   are the red one, shifted in hue
+	offsets = np.array([0.0, 2/3, 1/3], dtype=np.float32)
+
+	def draw(self, t):
+		hue = (self.position + t * 0.2) % 1.0
+		self.rgb[:] = np.clip(np.abs((hue[:, np.newaxis] + self.offsets) % 1.0 * 6 - 3) - 1, 0, 1) * 255
+
+
+class Breathing(Effect):
+	def draw(self, t):
+		level = (1 - np.cos(2 * np.pi * t * 0.25)) / 2
+		self.rgb[:] = self.palette[0] * level
+
+
+class GradientSweep(Effect):
+	def draw(self, t):
+		colors = len(self.palette)
+		# position along the palette, wrapping around to the first color
+		x = (self.position + t * 0.1) % 1.0 * colors
+		lo = x.astype(np.intp)
+		fraction = (x - lo)[:, np.newaxis]
+		self.rgb[:] = self.palette[lo] * (1 - fraction) + self.palette[(lo + 1) % colors] * fraction
+
+
+class Comet(Effect):
+	def __init__(self, tail=0.25, **params):
+		super().__init__(**params)
+		self.tail = tail
+
+	def draw(self, t):
+		head = t * 0.5 % 1.0
+		# distance behind the head, wrapping around the monitor
+		behind = (head - self.position) % 1.0
+		level = np.exp(-behind / (self.tail / 4))
+		self.rgb[:] = self.palette[0] * level[:, np.newaxis]
+
+
+class Fade(Effect):
+	def draw(self, t):
+		colors = len(self.palette)
+		x = t * 0.25 % colors
+		lo = int(x)
+		fraction = x - lo
+		self.rgb[:] = self.palette[lo] * (1 - fraction) + self.palette[(lo + 1) % colors] * fraction
+
+
+effects = {
+	'rainbow': Rainbow,
+	'breathing': Breathing,
+	'sweep': GradientSweep,
+	'comet': Comet,
+	'fade': Fade,
+}
+
+def create(name, **params):
+	if name not in effects:
+		raise ValueError(f'unknown effect {name!r}, must be one of: {", ".join(effects)}')
+	return effects[name](**params)
+
+
+################################################################################
+################################################################################
+
+
+class EffectSource(videosync.FrameSource):
+	def __init__(self, effect):
+		self.effect = effect
+		self.started = None
+
+	def read(self):
+		now = time.perf_counter()
+		if self.started is None:
+			self.started = now
+		return self.effect.render(now - self.started)
+
+
+def pipeline(effect, devs, fps=60):
+	# the frames are already (48, 3), so there is nothing to reduce
+	return videosync.VideoSync(EffectSource(effect), devs, fps, reducer=lambda frame: frame)
+
+def play(effect, devs, fps=60):
+	result = pipeline(effect, devs, fps)
+	result.start()
+	return result
+
+
+################################################################################
+################################################################################
+
+if __name__ == '__main__':
+	# how long each effect takes to render a frame
+	for name, cls in effects.items():
+		effect = cls()
+		count = 10000
+		started = time.perf_counter()
+		for i in range(count):
+			effect.render(i / 60)
+		elapsed = time.perf_counter() - started
+		print(f'{name:10} {elapsed / count * 1e6:6.1f} us per frame')
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+
+# Virtual monitors, for testing without hardware
+#
+# A VirtualMonitor can be used anywhere a hid.Device is expected. It decodes
+#   every report written to it the way the monitor would, checks the framing
+#   and CRC, reassembles three-report video sync frames, and keeps track of
+#   what the LEDs would show. It can also simulate slow or failing writes.
+#
+# The easiest way to use it is to set the LIB27GN950_EMULATE environment
+#   variable before starting any program that uses lib27gn950 (console.py,
+#   gui.py, benchmark.py, your own code...). find_monitors() then also returns
+#   that many virtual monitors, and lib27gn950.open_device() opens them:
+#     LIB27GN950_EMULATE=2 ./console.py info
+#     LIB27GN950_EMULATE='4,latency=0.001,jitter=0.0005,failure_rate=0.01' ./gui.py
+#
+#
+# Protocol, as understood by the decoder:
+#   Every message is   53 43 cT 02 LL [LL bytes of payload] CRC 45 44
+#   where T is the message type, LL the payload length, and CRC is crc8 of
+#   everything before it. Messages are sent in 64-byte reports, padded with
+#   zeroes. Video sync messages (type 1) are 153 bytes long, split over three
+#   reports.
+#     type f   payload 01 00          turn on
+#              payload 02 00          turn off
+#              payload 01 NN          brightness NN (1..12)
+#     type a   payload 03 NN          mode: 1..4 static color slot,
+#                                     5 peaceful, 6 dynamic, 8 video sync
+#     type d   payload 0S RR GG BB    set the color of slot S
+#     type 1   payload 00 + 48 RGB    video sync frame
+#
+#
+# API documentation:
+#
+# VirtualMonitor(serial='VIRTUAL0', model='27GN950 / 38GN950', latency=0.0,
+#                jitter=0.0, failure_rate=0.0, strict=True, seed=None,
+#                capacity=None, buffer=8, ack=False)
+#   `latency` + a random value up to `jitter` is the time each write takes,
+#     in seconds
+#   `failure_rate` is the probability of a write failing with
+#     hid.HIDException, like it would for an unplugged monitor
+#   `capacity` simulates firmware that processes that many reports per second,
+#     with room for `buffer` reports waiting to be processed. A report that
+#     arrives when there's no room is lost, and counted as an overrun error.
+#   With `ack`, the monitor answers every message with a report, which can be
+#     read() once the message has been processed (see flowcontrol.py)
+#   If `strict` is True, an invalid report raises ProtocolError from write().
+#     Either way, it is counted in stats()['errors'] and kept in `errors`.
+#   Attributes describing the monitor's state:
+#     power, mode, brightness, colors (list of 4 color strings),
+#     video_sync (the last video sync frame, a list of 48 color strings)
+#   leds()         Return what the 48 LEDs show, as a list of color strings, or
+#                  None in the peaceful / dynamic modes (which are animated
+#                  by the monitor itself)
+#   commands       list of the decoded messages, as (name, value) tuples
+#   stats()        Return counters of writes, bytes, messages, errors,
+#                  overruns and failures, and the time spent in writes
+#   unplug()   plug()
+#                  Simulate unplugging / plugging in the monitor
+#
+#
+# install(count, **options)
+#   Add `count` VirtualMonitors (with serials VIRTUAL0, VIRTUAL1, ...) to the
+#     monitors found by lib27gn950.find_monitors(), which can then be opened
+#     with lib27gn950.open_device(). `options` are passed to VirtualMonitor.
+#     Returns the list of monitors. Each open_device() returns a new handle to
+#     the same VirtualMonitor, so its state survives reopening.
+#
+# uninstall()
+#   Remove the installed monitors
+#
+# installed()
+#   Return the list of installed monitors
+
+################################################################################
+
+import os
+import random
+import sys
+import time
+from collections import deque
+from threading import Lock
+
+import hid
+
+import lib27gn950
+from crc8 import crc8
+
+
+class ProtocolError(ValueError):
+	pass
+
+
+path_prefix = b'virtual:'
+
+header = bytes.fromhex('5343')
+end = bytes.fromhex(lib27gn950.command_end)
+mode_names = {
+	1: 'color1', 2: 'color2', 3: 'color3', 4: 'color4',
+	5: 'color_peaceful', 6: 'color_dynamic', 8: 'color_video_sync',
+}
+
+
+################################################################################
+################################################################################
+
+
+class VirtualMonitor:
+	def __init__(self, serial='VIRTUAL0', model='27GN950 / 38GN950', latency=0.0,
+			jitter=0.0, failure_rate=0.0, strict=True, seed=None,
+			capacity=None, buffer=8, ack=False):
+		self.serial = serial
+		self.model = model
+		self.path = path_prefix + serial.encode()
+		self.latency = latency
+		self.jitter = jitter
+		self.failure_rate = failure_rate
+		self.strict = strict
+		self.capacity = capacity
+		self.buffer = int(buffer)
+		self.ack = ack
+		self.random = random.Random(seed)
+		self.lock = Lock()
+		self.plugged_in = True
+
+		self.power = None
+		self.mode = None
+		self.brightness = None
+		self.colors = [None] * 4
+		self.video_sync = None
+
+		self.partial = bytearray()
+		self.partial_length = 0
+		# when the simulated firmware is done with the reports received so far
+		self.busy_until = 0.0
+		# (time, report) of the answers that haven't been read yet
+		self.acks = deque()
+		self.commands = []
+		self.errors = []
+		self.counters = {
+			'writes': 0, 'bytes': 0, 'messages': 0, 'video_sync_frames': 0,
+			'errors': 0, 'overruns': 0, 'failures': 0, 'write_time': 0.0,
+		}
+
+	def __repr__(self):
+		return f'<VirtualMonitor {self.serial!r}>'
+
+	############################################################################
+
+	def write(self, data):
+		if not self.plugged_in:
+			raise hid.HIDException('device unplugged')
+
+		delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0.0)
+		if delay:
+			time.sleep(delay)
+		if self.failure_rate and self.random.random() < self.failure_rate:
+			self.counters['failures'] += 1
+			raise hid.HIDException('injected write failure')
+
+		data = bytes(data)
+		with self.lock:
+			self.counters['writes'] += 1
+			self.counters['bytes'] += len(data)
+			self.counters['write_time'] += delay
+			try:
+				if self.capacity:
+					self._process(data)
+				self._receive(data)
+			except ProtocolError as e:
+				self.counters['errors'] += 1
+				self.errors.append((str(e), data))
+				self.partial.clear()
+				if self.strict:
+					raise
+		return len(data)
+
+	def read(self, size, timeout=None):
+		# `timeout` in milliseconds, like hid.Device.read
+		if not self.plugged_in:
+			raise hid.HIDException('device unplugged')
+		with self.lock:
+			ready, report = self.acks.popleft() if self.acks else (None, None)
+		if report is None:
+			# nothing to wait for, except the timeout
+			if timeout:
+				time.sleep(timeout / 1000)
+			return b''
+		delay = ready - time.perf_counter()
+		if delay > 0:
+			time.sleep(delay)
+		return report[:size]
+
+	def close(self):
+		pass
+
+	def unplug(self):
+		self.plugged_in = False
+
+	def plug(self):
+		self.plugged_in = True
+		self.partial.clear()
+		self.acks.clear()
+
+	############################################################################
+
+	def _process(self, data):
+		# queue the report for the simulated firmware
+		now = time.perf_counter()
+		if self.busy_until - now > self.buffer / self.capacity:
+			self.counters['overruns'] += 1
+			raise ProtocolError('report lost, the firmware is still busy with the previous ones')
+		self.busy_until = max(now, self.busy_until) + 1 / self.capacity
+
+	def _receive(self, data):
+		size = len(lib27gn950.report_prefix) + lib27gn950.report_size
+		if len(data) != size:
+			raise ProtocolError(f'report is {len(data)} bytes, expected {size}')
+		report = data[len(lib27gn950.report_prefix):]
+
+		if self.partial:
+			# continuation of a message that didn't fit in one report
+			self.partial += report
+		else:
+			if report[:2] != header or report[2] >> 4 != 0xc or report[3] != 0x02:
+				raise ProtocolError(f'bad message header {report[:4].hex()}')
+			self.partial_length = 5 + report[4] + 3
+			self.partial += report
+
+		if len(self.partial) < self.partial_length:
+			return
+		message = bytes(self.partial[:self.partial_length])
+		padding = self.partial[self.partial_length:]
+		self.partial.clear()
+		if any(padding):
+			raise ProtocolError('report is not zero-padded after the end of the message')
+		self._decode(message)
+		if self.ack:
+			answer = message[:4] + b'\x00'
+			answer += bytes((crc8(answer),)) + end
+			self.acks.append((max(self.busy_until, time.perf_counter()), answer.ljust(lib27gn950.report_size, b'\x00')))
+
+	def _decode(self, message):
+		length = message[4]
+		body = message[:5+length]
+		if message[-2:] != end:
+			raise ProtocolError(f'bad message end {message[-2:].hex()}')
+		if crc8(body) != message[-3]:
+			raise ProtocolError(f'bad CRC {message[-3]:02x}, expected {crc8(body):02x}')
+
+		kind = message[2] & 0x0f
+		payload = message[5:5+length]
+		if kind == 0xf and length == 2 and payload == b'\x01\x00':
+			self.power = True
+			self._log('turn_on', None)
+		elif kind == 0xf and length == 2 and payload == b'\x02\x00':
+			self.power = False
+			self._log('turn_off', None)
+		elif kind == 0xf and length == 2 and payload[0] == 1 and 1 <= payload[1] <= 12:
+			self.brightness = payload[1]
+			self._log('brightness', payload[1])
+		elif kind == 0xa and length == 2 and payload[0] == 3 and payload[1] in mode_names:
+			self.power = True
+			self.mode = mode_names[payload[1]]
+			self._log('mode', self.mode)
+		elif kind == 0xd and length == 4 and 1 <= payload[0] <= 4:
+			self.colors[payload[0]-1] = payload[1:4].hex()
+			self._log('set_color', (payload[0], payload[1:4].hex()))
+		elif kind == 0x1 and length == 145 and payload[0] == 0:
+			colors = payload[1:]
+			if 0 in colors:
+				raise ProtocolError('video sync color component of 0, which can crash the monitor')
+			self.video_sync = [colors[i:i+3].hex() for i in range(0, 144, 3)]
+			self.counters['video_sync_frames'] += 1
+			self._log('video_sync', self.video_sync)
+		else:
+			raise ProtocolError(f'unknown message {message.hex()}')
+
+	def _log(self, name, value):
+		self.counters['messages'] += 1
+		self.commands.append((name, value))
+
+	############################################################################
+
+	def leds(self):
+		if not self.power:
+			return ['000000'] * 48
+		if self.mode in ('color1', 'color2', 'color3', 'color4'):
+			return [self.colors[int(self.mode[-1])-1] or '000000'] * 48
+		if self.mode == 'color_video_sync':
+			return list(self.video_sync or ['000000'] * 48)
+		return None
+
+	def stats(self):
+		with self.lock:
+			return dict(self.counters)
+
+
+################################################################################
+################################################################################
+
+
+_installed = []
+
+def install(count, **options):
+	seed = options.pop('seed', None)
+	monitors = []
+	for i in range(count):
+		# a different seed per monitor, so they don't all fail at once
+		options['seed'] = None if seed is None else seed + i
+		monitors.append(VirtualMonitor(f'VIRTUAL{len(_installed) + i}', **options))
+	_installed.extend(monitors)
+	lib27gn950.virtual_backend = sys.modules[__name__]
+	return monitors
+
+def uninstall():
+	_installed.clear()
+	lib27gn950.virtual_backend = None
+
+def installed():
+	return list(_installed)
+
+def find_monitors():
+	return [
+		{'path': monitor.path, 'serial': monitor.serial, 'model': monitor.model}
+		for monitor in _installed if monitor.plugged_in
+	]
+
+def open_device(path):
+	for monitor in _installed:
+		if monitor.path == path and monitor.plugged_in:
+			return VirtualHandle(monitor)
+	raise hid.HIDException('unable to open device: no such virtual monitor')
+
+
+class VirtualHandle:
+	# an open handle to a VirtualMonitor, which stops working once closed,
+	#   like a hid.Device does
+	def __init__(self, monitor):
+		self.monitor = monitor
+		self.serial = monitor.serial
+		self.closed = False
+
+	def write(self, data):
+		if self.closed:
+			raise hid.HIDException('device closed')
+		return self.monitor.write(data)
+
+	def read(self, size, timeout=None):
+		if self.closed:
+			raise hid.HIDException('device closed')
+		return self.monitor.read(size, timeout)
+
+	def close(self):
+		self.closed = True
+
+
+def install_from_env(value):
+	# e.g. '4,latency=0.001,jitter=0.0005,failure_rate=0.01,strict=false'
+	parts = [part.strip() for part in value.split(',') if part.strip()]
+	options = {}
+	for part in parts[1:]:
+		key, option = part.split('=')
+		if key in ('strict', 'ack'):
+			options[key] = option.lower() == 'true'
+		elif key == 'seed':
+			options[key] = int(option)
+		else:
+			options[key] = float(option)
+	return install(int(parts[0]), **options)
+
+
+# at the end, as importing lib27gn950 imports this module when the variable is
+#   set, and the import can start from either one of them
+if os.environ.get('LIB27GN950_EMULATE') and not _installed:
+	install_from_env(os.environ['LIB27GN950_EMULATE'])
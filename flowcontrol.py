@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+
+# Flow control: write-rate limiting per device
+#
+# Nothing in USB stops a program from writing reports faster than the
+#   monitor's firmware can process them, and bad or garbled data can 'crash'
+#   the monitor. Every report lib27gn950 writes therefore goes through a token
+#   bucket per device: a device accepts `burst` reports at once, and `rate`
+#   reports per second after that.
+#
+# What happens when a write would exceed the budget depends on the policy:
+#   block      wait until the budget allows it (the default)
+#   drop       don't write it
+#   coalesce   keep it, replacing any frame kept before, and write it as
+#              soon as the budget allows, unless a newer one is written first
+#   The policy only applies to video sync frames, which are superseded by the
+#     next frame anyway. Every other command changes the monitor's state, so
+#     it always blocks.
+#
+# Acknowledgements: with `ack` enabled, every command is followed by a read
+#   from the device (waiting up to `ack_timeout` seconds). If the device
+#   answers, the next command waits for the answer to the previous one, and
+#   the rate is lowered to what the measured round trips allow. If it doesn't
+#   answer three times in a row without ever having answered, it is assumed
+#   not to support it, and only the configured rate is used.
+#
+# Limits are looked up by serial number first, then by model, like the color
+#   calibration profiles (see calibration.py), and fall back to
+#   `default_limit`. flowcontrol.ini, in the same directory as config.ini, is
+#   loaded by registry.default_registry(); the DEFAULT section applies to every
+#   other one:
+#
+#     [DEFAULT]
+#     policy = coalesce
+#
+#     [38GL950G]
+#     rate = 300
+#     burst = 16
+#     ack = true
+#
+# Running this file measures how fast the connected monitors take commands
+#   (see measure() below), and prints a flowcontrol.ini section for each.
+#
+#
+# API documentation:
+#
+# Limit(rate=500.0, burst=32, policy='block', ack=False, ack_timeout=0.05)
+#   `rate` in reports per second (a video sync frame is three reports), and
+#     `burst` in reports
+#
+# default_limit
+#   The Limit for devices without one of their own
+#
+# limits
+#   The dictionary of Limits by serial number or model. Call clear_cache()
+#     after changing it directly.
+#
+# set_limit(key, limit)
+#   Set (or with None, remove) the limit for a serial number or model
+#
+# load(path=None)
+#   Add the limits from an ini file, flowcontrol.ini in the config directory
+#     by default. A missing file is not an error.
+#
+# enable()   disable()
+#   Turn flow control on (the default) / off for every device
+#
+# enabled
+#   True while flow control is on
+#
+#
+# device_flow(dev)
+#   Return the DeviceFlow of a device, which lib27gn950 uses for every write.
+#     Attributes:
+#       limit            the Limit in use
+#       rate             the current rate, lower than limit.rate if the
+#                        acknowledgements showed that the device is slower
+#       blocked          writes that had to wait, and for how long in total
+#       blocked_time     (in seconds)
+#       dropped          video sync frames dropped
+#       coalesced        video sync frames replaced by a newer one before they
+#                        could be written
+#       acks             acknowledgements received, and the average round trip
+#       rtt              (in seconds, None until the first one)
+#       ack_supported    True / False, or None while it isn't known yet
+#     stats()   Return the attributes above as a dictionary
+#
+# flow_stats(dev)
+#   Return device_flow(dev).stats() if anything has been written to the device
+#     under flow control, otherwise None
+#
+#
+# measure(dev, frame=None, count=50, timeout=0.05)
+#   Write `frame` (a compiled report, by default the turn_on command, which
+#     turns the lighting on) `count` times as fast as the device takes it,
+#     waiting for an acknowledgement after each one if the device sends them,
+#     and return a dictionary with the achieved rate in reports per second,
+#     the number of acknowledgements and their mean round trip in ms.
+#     Flow control is bypassed while measuring.
+
+################################################################################
+
+import time
+from threading import Lock, Timer
+
+import devconfig
+import writers
+
+
+policies = ('block', 'drop', 'coalesce')
+
+enabled = True
+
+# report size, as hidapi reads at most one report
+_read_size = 64
+
+
+def enable():
+	global enabled
+	enabled = True
+
+def disable():
+	global enabled
+	enabled = False
+
+
+################################################################################
+################################################################################
+
+
+class Limit:
+	def __init__(self, rate=500.0, burst=32, policy='block', ack=False, ack_timeout=0.05):
+		if rate <= 0 or burst < 1:
+			raise ValueError('Limit: rate must be positive, and burst at least 1')
+		if policy not in policies:
+			raise ValueError(f'Limit: policy must be one of: {", ".join(policies)}')
+		self.rate = float(rate)
+		self.burst = int(burst)
+		self.policy = policy
+		self.ack = ack
+		self.ack_timeout = ack_timeout
+
+	def __repr__(self):
+		return f'<Limit rate={self.rate} burst={self.burst} policy={self.policy} ack={self.ack}>'
+
+
+class TokenBucket:
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = float(burst)
+		self.updated = time.perf_counter()
+
+	def delay(self, n):
+		# seconds until `n` reports can be written; a command larger than the
+		#   burst can be written once the bucket is full
+		now = time.perf_counter()
+		self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+		self.updated = now
+		missing = min(n, self.burst) - self.tokens
+		return missing / self.rate if missing > 0 else 0.0
+
+	def take(self, n):
+		self.tokens -= n
+
+
+################################################################################
+
+class DeviceFlow:
+	# used by the write jobs, which run with the device locked, so it doesn't
+	#   need a lock of its own (except for the coalescing timer)
+	def __init__(self, limit):
+		self.limit = limit
+		self.bucket = TokenBucket(limit.rate, limit.burst)
+		self.lock = Lock()
+		# (retry, writes) of the frame kept back; `writes` counts the writes
+		#   allowed, so the retry can tell whether anything newer was written
+		self.pending = None
+		self.writes = 0
+		self.timer = None
+		self.blocked = 0
+		self.blocked_time = 0.0
+		self.dropped = 0
+		self.coalesced = 0
+		self.acks = 0
+		self.rtt = None
+		self.ack_supported = None
+		self.ack_timeouts = 0
+
+	@property
+	def rate(self):
+		return self.bucket.rate
+
+	def acquire(self, dev, n, retry=None):
+		# Wait for the budget to write `n` reports, and return True. `retry`
+		#   is given for video sync frames, which are dropped or coalesced
+		#   instead of waiting, depending on the policy; then False is
+		#   returned, and retry(dev) is queued to the device's writer once
+		#   there is budget for it. As that is after the caller has moved on,
+		#   retry must own its data rather than refer to reused buffers.
+		delay = self.bucket.delay(n)
+		if delay > 0:
+			if retry is None or self.limit.policy == 'block':
+				self.blocked += 1
+				self.blocked_time += delay
+				time.sleep(delay)
+				self.bucket.delay(n)
+			elif self.limit.policy == 'drop':
+				self.dropped += 1
+				return False
+			else:
+				with self.lock:
+					if self.pending is not None:
+						self.coalesced += 1
+					self.pending = (retry, self.writes)
+					if self.timer is None:
+						self.timer = Timer(delay, self._flush, (dev,))
+						self.timer.daemon = True
+						self.timer.start()
+				return False
+		if retry is not None and self.pending is not None:
+			# a newer frame than the one kept back is being written
+			with self.lock:
+				if self.pending is not None:
+					self.coalesced += 1
+					self.pending = None
+		self.writes += 1
+		self.bucket.take(n)
+		return True
+
+	def _flush(self, dev):
+		with self.lock:
+			pending = self.pending
+			self.pending = None
+			self.timer = None
+		if pending is not None:
+			writers.get_writer(dev).submit(lambda _dev: self._retry(_dev, *pending))
+
+	def _retry(self, dev, retry, writes):
+		# runs with the device locked. A single-device write doesn't go
+		#   through the queue, so a newer one may have been written between
+		#   the timer firing and now, and the kept frame would undo it.
+		if self.writes != writes:
+			self.coalesced += 1
+			return
+		retry(dev)
+
+	def acknowledge(self, dev, n, started):
+		# called after writing a command of `n` reports, if acks are enabled
+		if self.ack_supported is False:
+			return
+		data = dev.read(_read_size, max(1, round(self.limit.ack_timeout * 1000)))
+		if not data:
+			self.ack_timeouts += 1
+			if self.ack_supported is None and self.ack_timeouts >= 3:
+				self.ack_supported = False
+			return
+		rtt = time.perf_counter() - started
+		self.ack_supported = True
+		self.acks += 1
+		self.rtt = rtt if self.rtt is None else self.rtt * 0.9 + rtt * 0.1
+		# don't let a burst run ahead of what the device has been keeping up with
+		self.bucket.rate = min(self.limit.rate, n / self.rtt)
+
+	def stats(self):
+		return {
+			'rate': self.rate,
+			'policy': self.limit.policy,
+			'blocked': self.blocked,
+			'blocked_time': self.blocked_time,
+			'dropped': self.dropped,
+			'coalesced': self.coalesced,
+			'acks': self.acks,
+			'rtt_ms': self.rtt * 1000 if self.rtt is not None else None,
+			'ack_supported': self.ack_supported,
+		}
+
+
+################################################################################
+################################################################################
+
+
+default_limit = Limit()
+limits = {}
+
+_device_flows = devconfig.DeviceCache(
+	lambda dev: DeviceFlow(devconfig.lookup(limits, dev, default_limit))
+)
+
+
+def clear_cache():
+	_device_flows.clear()
+
+def set_limit(key, limit):
+	if limit is None:
+		limits.pop(key, None)
+	else:
+		limits[key] = limit
+	clear_cache()
+
+def load(path=None):
+	if path is None:
+		path = devconfig.config_path('flowcontrol.ini')
+	parser = devconfig.read_ini(path)
+	if parser is None:
+		return
+	global default_limit
+	sections = [('DEFAULT', parser.defaults())] + [(key, parser[key]) for key in parser.sections()]
+	for key, section in sections:
+		if key == 'DEFAULT' and not section:
+			continue
+		params = {}
+		try:
+			if 'rate' in section:
+				params['rate'] = float(section['rate'])
+			if 'burst' in section:
+				params['burst'] = int(section['burst'])
+			if 'policy' in section:
+				params['policy'] = section['policy'].strip().lower()
+			if 'ack' in section:
+				params['ack'] = section['ack'].strip().lower() in ('true', 'yes', 'on', '1')
+			if 'ack_timeout' in section:
+				params['ack_timeout'] = float(section['ack_timeout'])
+			limit = Limit(**params)
+		except ValueError as e:
+			raise ValueError(f'{path}: [{key}]: {e}') from None
+		if key == 'DEFAULT':
+			default_limit = limit
+		else:
+			limits[key] = limit
+	clear_cache()
+
+
+def device_flow(dev):
+	return _device_flows.get(dev)
+
+def flow_stats(dev):
+	flow = _device_flows.cached(dev)
+	return flow.stats() if flow is not None else None
+
+
+################################################################################
+################################################################################
+
+
+def measure(dev, frame=None, count=50, timeout=0.05):
+	if frame is None:
+		import lib27gn950
+		frame = lib27gn950.control_frames['turn_on']
+	timeout_ms = max(1, round(timeout * 1000))
+	acks = 0
+	rtt = 0.0
+	with writers.get_writer(dev).lock:
+		# find out whether the device answers at all
+		dev.write(frame)
+		answers = bool(dev.read(_read_size, timeout_ms))
+		started = time.perf_counter()
+		for i in range(count):
+			sent = time.perf_counter()
+			dev.write(frame)
+			if answers and dev.read(_read_size, timeout_ms):
+				acks += 1
+				rtt += time.perf_counter() - sent
+		elapsed = time.perf_counter() - started
+	return {
+		'rate': count / elapsed,
+		'acks': acks,
+		'rtt_ms': rtt / acks * 1000 if acks else None,
+	}
+
+
+################################################################################
+################################################################################
+
+if __name__ == '__main__':
+	import lib27gn950
+
+	monitors = lib27gn950.find_monitors()
+	if not monitors:
+		print('No monitors found')
+	for monitor in monitors:
+		dev = lib27gn950.open_device(monitor['path'])
+		try:
+			result = measure(dev)
+		finally:
+			dev.close()
+		print(f'# {monitor["model"]}: {result["rate"]:.0f} reports/s, ', end='')
+		if result['acks']:
+			print(f'{result["acks"]} acknowledgements, round trip {result["rtt_ms"]:.2f} ms')
+		else:
+			print('no acknowledgements')
+		# leave some headroom below the measured rate
+		print(f'[{monitor["serial"] or monitor["model"]}]')
+		print(f'rate = {result["rate"] * 0.8:.0f}')
+		if result['acks']:
+			print('ack = true')
+		print()
@@ -4,18 +4,26 @@ import os
 import re
 import sys
 from math import ceil
-from threading import Thread
 
 import darkdetect
-import hid
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
 import lib27gn950
+import metrics
+import registry
+import scenes
+import scheduler
 from helpers import Config
 from mqtt import MQTT
 
+try:
+    import daemon
+except ImportError:
+    # the GUI works without it, it just can't host the daemon
+    daemon = None
+
 log = logging.getLogger(__name__)
 
 # https://pypi.org/project/hid/
@@ -23,10 +31,18 @@ log = logging.getLogger(__name__)
 
 
 class Gui(QWidget):
+    # emitted from the MQTT connection thread, delivered on the Qt thread
+    mqtt_status = pyqtSignal(bool)
+
     def __init__(self):
         super().__init__()
         self.config = Config()
         self.devs = []
+        # the videosync.VideoSync pipeline running a software effect
+        self.effect = None
+        # button clicks and slider moves are sent from the scheduler's thread,
+        # so the UI never waits on USB writes, and slider drags are coalesced
+        self.scheduler = scheduler.default_scheduler()
         self.is_mqtt_available = hasattr(self.config, "mqtt")
         if self.is_mqtt_available:
             self.m = MQTT(
@@ -39,8 +55,18 @@ class Gui(QWidget):
                 self.config.mqtt_user,
                 self.config.mqtt_password,
                 self.config.mqtt_tls,
+                getattr(self.config, "mqtt_stats_topic", None),
+                getattr(self.config, "mqtt_stats_interval", 30),
+                getattr(self.config, "mqtt_client_id", None),
+                getattr(self.config, "mqtt_turn_off_on_disconnect", True),
+                getattr(self.config, "mqtt_disconnect_grace", 30),
             )
+            self.m.on_status = self.mqtt_status.emit
         self.hide_on_startup = self.config.hide_on_startup
+        # shown in the monitor checkbox tooltips
+        metrics.enable()
+        if hasattr(self.config, "metrics_port"):
+            metrics.serve(self.config.metrics_port)
 
     def init_ui(self):
         self.setWindowTitle("27g950controller")
@@ -61,10 +87,15 @@ class Gui(QWidget):
 
         mqqt_checkbox = QCheckBox()
         mqqt_checkbox.setCheckState(0)
+        self.mqtt_status.connect(
+            lambda connected: mqqt_checkbox.setToolTip(
+                "Connected" if connected else "Not connected, retrying"
+            )
+        )
         # ugly
         if self.is_mqtt_available:
             if self.config.mqtt:
-                self.start_mqtt(mqqt_checkbox)
+                self.start_mqtt()
                 mqqt_checkbox.setCheckState(2)
             else:
                 self.stop_mqtt()
@@ -72,9 +103,7 @@ class Gui(QWidget):
             mqqt_checkbox.setDisabled(True)
 
         mqqt_checkbox.stateChanged.connect(
-            lambda checked: (
-                self.start_mqtt(mqqt_checkbox) if checked == 2 else self.stop_mqtt()
-            )
+            lambda checked: (self.start_mqtt() if checked == 2 else self.stop_mqtt())
         )
         self.selectionMqttLayout.addWidget(mqqt_checkbox)
 
@@ -121,6 +150,13 @@ class Gui(QWidget):
         x = QPushButton("Dynamic")
         x.clicked.connect(self.set_dynamic_color)
         configbuttonslayout.addWidget(x, 2, 2, 1, 2)
+        effectslayout = QHBoxLayout()
+        for name in ["rainbow", "breathing", "sweep", "comet", "fade"]:
+            x = QPushButton(name.capitalize())
+            x.setToolTip("Breathing and comet use the color entered below")
+            x.clicked.connect(lambda _, name=name: self.start_effect(name))
+            effectslayout.addWidget(x)
+        configbuttonslayout.addLayout(effectslayout, 3, 0, 1, 4)
         mainLayout.addLayout(configbuttonslayout)
 
         mainLayout.addWidget(QLabel(""))
@@ -152,31 +188,115 @@ class Gui(QWidget):
         editbuttonslayout.addLayout(editbuttonsbuttonslayout)
         mainLayout.addLayout(editbuttonslayout)
 
-    def init_monitors(self):
-        monitors = lib27gn950.find_monitors()
-        if not monitors:
-            for item in self.layout().children():
-                self.layout().removeItem(item)
-            self.layout().addWidget(QLabel("No monitors found"))
-            return
-
-        for monitor in monitors:
-            self.devs.append(hid.Device(path=monitor["path"]))
+        mainLayout.addWidget(QLabel(""))
 
-        self.selection = list(range(len(self.devs)))
+        scenebuttonslayout = QHBoxLayout()
+        scenebuttonslayout.addWidget(QLabel("<b>Scene: </b>"))
+        self.sceneBox = QComboBox()
+        self.sceneBox.setEditable(True)
+        self.sceneBox.addItems(scenes.names())
+        scenebuttonslayout.addWidget(self.sceneBox, 1)
+        x = QPushButton("Apply")
+        x.setToolTip("Only what differs from the current state is sent")
+        x.clicked.connect(self.apply_scene)
+        scenebuttonslayout.addWidget(x)
+        x = QPushButton("Save")
+        x.setToolTip("Save what the selected monitors show under this name")
+        x.clicked.connect(self.save_scene)
+        scenebuttonslayout.addWidget(x)
+        x = QPushButton("Delete")
+        x.clicked.connect(self.delete_scene)
+        scenebuttonslayout.addWidget(x)
+        mainLayout.addLayout(scenebuttonslayout)
 
-        for i in self.selection:
+    def init_monitors(self):
+        self.registry = registry.default_registry()
+        self.selection = []
+        self.monitor_checkboxes = []
+        self.no_monitors_label = None
+        monitors = self.registry.devices()
+        if monitors:
+            self.show_monitors(monitors)
+        else:
+            # the controls come back once update_monitors finds a monitor
+            self.set_controls_visible(False)
+            self.no_monitors_label = QLabel("No monitors found")
+            self.layout().addWidget(self.no_monitors_label)
+
+        # enumeration happens on the registry's thread, the timer only picks
+        # up monitors that it has found since
+        self.registry.start_polling()
+        if getattr(self.config, "daemon", False) and daemon is not None:
+            # lets console.py commands use the monitors opened here
+            server = daemon.Daemon(self.registry)
+            try:
+                server.start()
+                self.daemon = server
+            except daemon.DaemonError as e:
+                log.warning("Not starting the daemon: %s", e)
+        self.monitor_timer = QTimer(self)
+        self.monitor_timer.timeout.connect(self.update_monitors)
+        self.monitor_timer.start(1000)
+
+    def show_monitors(self, monitors):
+        self.add_monitors(monitors)
+        if getattr(self.config, "restore_scene", True):
+            scenes.restore(monitors)
+
+    def set_controls_visible(self, visible):
+        layouts = [self.layout()]
+        while layouts:
+            layout = layouts.pop()
+            for i in range(layout.count()):
+                item = layout.itemAt(i)
+                if item.widget() is not None:
+                    item.widget().setVisible(visible)
+                elif item.layout() is not None:
+                    layouts.append(item.layout())
+
+    def add_monitors(self, monitors):
+        for dev in monitors:
+            if dev in self.devs:
+                continue
+            i = len(self.devs)
+            self.devs.append(dev)
+            self.selection.append(i)
             x = QCheckBox(str(i + 1))
+            x.setToolTip(f"{dev.model}, serial {dev.serial}")
+            self.monitor_checkboxes.append(x)
             x.setCheckState(2)
             x.stateChanged.connect(
                 lambda checked, i=i: self.update_selection(i, checked)
             )
             self.selectionbuttonslayout.addWidget(x)
 
+    def update_monitors(self):
+        monitors = self.registry.devices()
+        if self.no_monitors_label is not None and monitors:
+            # the first monitor since starting without any
+            self.layout().removeWidget(self.no_monitors_label)
+            self.no_monitors_label.deleteLater()
+            self.no_monitors_label = None
+            self.set_controls_visible(True)
+            self.show_monitors(monitors)
+        self.add_monitors(monitors)
+        for dev, checkbox in zip(self.devs, self.monitor_checkboxes):
+            m = metrics.device_metrics(dev)
+            state = "" if dev.connected else " (disconnected)"
+            checkbox.setToolTip(
+                f"{dev.model}, serial {dev.serial}{state}\n"
+                f"{m.commands} commands, {m.bytes} bytes, {m.errors} errors\n"
+                f"write latency p50 {m.latency.percentile(0.5) * 1000:.2f} ms, "
+                f"p99 {m.latency.percentile(0.99) * 1000:.2f} ms"
+            )
+
     def cleanup(self):
-        if hasattr(self, "devs"):
-            for dev in self.devs:
-                dev.close()
+        self.stop_effect()
+        if hasattr(self, "daemon"):
+            self.daemon.close()
+        self.scheduler.close()
+        if hasattr(self, "registry"):
+            self.registry.close()
 
     def is_valid_color(self, color):
         return re.match("^[0-9a-f]{6}$", color)
@@ -191,39 +311,97 @@ class Gui(QWidget):
         elif checked == 2:
             self.selection.append(monitor_num)
 
-    def send_command(self, cmd):
+    def send_command(self, cmd, key=None):
         devs = []
         for i in self.selection:
-            devs.append(self.devs[i])
-        lib27gn950.send_command(cmd, devs)
+            if self.devs[i].connected:
+                devs.append(self.devs[i])
+        self.scheduler.submit(cmd, devs, key)
 
     def turn_on(self):
         cmd = lib27gn950.control_commands["turn_on"]
         self.send_command(cmd)
 
     def turn_off(self):
+        self.stop_effect()
         cmd = lib27gn950.control_commands["turn_off"]
         self.send_command(cmd)
 
     def set_static_color(self, color):
+        self.stop_effect()
         cmd = lib27gn950.control_commands["color" + str(color)]
         self.send_command(cmd)
 
     def set_peaceful_color(self):
+        self.stop_effect()
         cmd = lib27gn950.control_commands["color_peaceful"]
         self.send_command(cmd)
 
     def set_dynamic_color(self):
+        self.stop_effect()
         cmd = lib27gn950.control_commands["color_dynamic"]
         self.send_command(cmd)
 
+    def start_effect(self, name):
+        import effects
+
+        self.stop_effect()
+        # so a mode change that is still pending can't end the effect
+        self.scheduler.flush()
+        palette = None
+        color = self.colorInputBox.text().lower()
+        if name in ["breathing", "comet"] and self.is_valid_color(color):
+            palette = [color]
+        devs = [self.devs[i] for i in self.selection if self.devs[i].connected]
+        self.effect = effects.play(effects.create(name, palette=palette), devs)
+
+    def stop_effect(self):
+        if self.effect is not None:
+            self.effect.stop()
+            self.effect = None
+
+    def selected_devs(self):
+        return [self.devs[i] for i in self.selection if self.devs[i].connected]
+
+    def apply_scene(self):
+        name = self.sceneBox.currentText().strip().lower()
+        if name not in scenes.names():
+            return
+        self.stop_effect()
+        # the plan is made against the state after anything still pending
+        self.scheduler.flush()
+        scenes.apply(name, self.selected_devs())
+
+    def save_scene(self):
+        name = self.sceneBox.currentText().strip().lower()
+        if not name:
+            return
+        self.scheduler.flush()
+        scenes.save(name, self.selected_devs())
+        self.sceneBox.clear()
+        self.sceneBox.addItems(scenes.names())
+        self.sceneBox.setCurrentText(name)
+
+    def delete_scene(self):
+        name = self.sceneBox.currentText().strip().lower()
+        if name not in scenes.names():
+            return
+        scenes.delete(name)
+        self.sceneBox.clear()
+        self.sceneBox.addItems(scenes.names())
+
     def set_brightness(self, brt):
+        # one key for both cases, so only the final slider position is sent
         if brt < 1 or brt > 12:
-            self.turn_off()
+            # like the off button, as the effect would keep writing frames
+            self.stop_effect()
+            cmd = lib27gn950.control_commands["turn_off"]
         else:
-            self.turn_on()
-            cmd = lib27gn950.brightness_commands[brt]
-            self.send_command(cmd)
+            cmd = (
+                lib27gn950.control_commands["turn_on"],
+                lib27gn950.brightness_commands[brt],
+            )
+        self.send_command(cmd, key="brightness")
 
     def set_color(self, slot):
         color = self.colorInputBox.text().lower()
@@ -236,20 +414,15 @@ class Gui(QWidget):
         brightness = value * 0.12
         self.set_brightness(ceil(brightness))
 
-    def start_mqtt(self, checkbox):
+    def start_mqtt(self):
         if not self.is_mqtt_available:
             return
-
-        t = Thread(
-            target=self.m.connect,
-            args=(checkbox,),
-        )
-        t.start()
+        self.m.start()
 
     def stop_mqtt(self):
         if not self.is_mqtt_available:
             return
-        self.m.disconnect(force=True)
+        self.m.stop()
 
 
 class Tray(QSystemTrayIcon):
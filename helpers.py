@@ -2,6 +2,7 @@ import os
 import logging
 import pathlib
 import platform
+import re
 
 log = logging.getLogger(__name__)
 
@@ -13,22 +14,27 @@ def return_type(value):
     if value.isnumeric():
         return int(value)
 
+    if re.fullmatch(r"\d+\.\d+", value):
+        return float(value)
+
     return value
 
 
+def config_dir():
+    match platform.system():
+        case "Darwin":
+            return (
+                pathlib.Path.home() / "Library/Application "
+                "Support/BiasController/"
+            )
+        case "Windows":
+            return pathlib.Path(os.environ['APPDATA']) / "BiasController"
+    return pathlib.Path()
+
+
 class Config:
     def __init__(self):
-        self.config = pathlib.Path()
-        match platform.system():
-            case "Darwin":
-                self.config = (
-                    pathlib.Path.home() / "Library/Application "
-                    "Support/BiasController/"
-                )
-            case "Windows":
-                self.config = pathlib.Path(os.environ['APPDATA']) / "BiasController"
-
-        self.config /= "config.ini"
+        self.config = config_dir() / "config.ini"
 
         self.config_exist = False
         self.read_config()
@@ -40,7 +46,7 @@ class Config:
 
         with self.config.open("r") as f:
             for line in f.readlines():
-                if not line.strip():
+                if not line.strip() or line.lstrip().startswith("#"):
                     continue
 
                 key, value = line.strip().split("=")
@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 
-import os, platform, ctypes
+import os, platform, ctypes, time
+from functools import lru_cache
+from threading import Barrier, BrokenBarrierError, Lock
+from weakref import WeakKeyDictionary
 if 'Windows' in platform.system():
 	ctypes.windll.LoadLibrary(os.path.dirname(os.path.abspath(__file__)) + os.path.sep + 'hidapi.dll')
 
@@ -8,6 +11,12 @@ import hid
 # https://pypi.org/project/hid/
 # https://github.com/apmorton/pyhidapi
 
+from crc8 import crc8, Crc8
+import calibration
+import flowcontrol
+import metrics
+import writers
+
 # Library API documentation:
 #
 # Note: A small example program is located at the bottom of this file
@@ -23,9 +32,19 @@ import hid
 #     with hid.Device(path=monitors[0]['path']) as monitor0_dev:
 #       ... do stuff ...
 #       side note: `monitor0_dev.serial` is a string containing the serial number
+#   Every call enumerates all HID devices. registry.py provides a cached
+#     registry of monitors, keyed by serial, that keeps their handles open and
+#     reopens them when they are unplugged and plugged back in.
+#
+#
+# open_device(path)
+#   Open the monitor with the given path (from find_monitors). This is the same
+#     as hid.Device(path=path), but also works for the virtual monitors from
+#     emulator.py, which are enabled with the LIB27GN950_EMULATE environment
+#     variable.
 #
 #
-# send_command(cmd, dev)
+# send_command(cmd, dev, force=False)
 #   Given a command(s), send it to the device
 #   `dev` must be an open hid.Device instance, or an iterable of them
 #   `cmd` must be either an 11-character hex string, or an iterable of
@@ -43,13 +62,87 @@ import hid
 #       Option B:
 #       send_command(cmds, dev)
 #
+#   Commands that would not change anything (see device_state below) are not
+#     sent, unless `force` is True.
+#
+#
+# send_device_commands(commands, force=False)
+#   Send different command(s) to each device, in parallel
+#   `commands` is a dictionary (or an iterable of pairs) mapping each open
+#     hid.Device instance to its command(s), as for send_command. scenes.py
+#     uses this to apply a scene.
 #
-# send_raw_command(cmd, dev)
+#
+# send_raw_command(cmd, dev, force=False)
 #   Send a command to the device
 #   `dev` must be an open hid.Device instance, or an iterable of them
 #   `cmd` must be a 128-character hex string (representing 64 bytes)
 #
 #
+# compile_command(cmd)
+#   Compile an 11-character hex command (the same strings accepted by
+#     send_command) into a ready-to-write `bytes` report. The result is
+#     cached, so compiling the same command twice costs a dict lookup.
+#
+#
+# compile_raw_command(cmd)
+#   Same as compile_command, but for a 128-character raw hex string
+#
+#
+# send_frames(frames, dev, force=False)
+#   Write precompiled reports (from compile_command / compile_raw_command, or
+#     the control_frames / brightness_frames dictionaries) to the device(s).
+#   `frames` must be a `bytes` report or an iterable of them
+#   `dev` must be an open hid.Device instance, or an iterable of them
+#   This skips all hex string handling, so it is the fastest way to send
+#     the same commands repeatedly:
+#       frame = compile_command(control_commands['color2'])
+#       send_frames(frame, devs)
+#
+#
+# device_state(dev)
+#   Return the DeviceState for an open hid.Device. The library keeps track of
+#     what it has sent to each device, and the send functions skip writes that
+#     would not change anything (pass force=True to send them anyway).
+#   The state starts out unknown, so the first write of anything is always
+#     sent. It also becomes unknown after a raw command the library can't
+#     interpret. DeviceState attributes (None means unknown):
+#       power        True / False
+#       mode         a control_commands key, e.g. 'color2' or 'color_dynamic'
+#       brightness   an integer in the range [1..12]
+#       colors       a list with the color string of each of the 4 slots
+#       video_sync   a hash of the last video sync frame
+#   Call reset() on it if the monitor may have been changed by other means,
+#     e.g. with the scroll wheel on the monitor.
+#
+#
+# Thread safety and multiple monitors:
+#   All of the send functions may be called from any thread. Writes to the same
+#     device are serialized, and when several devices are given, they are
+#     written to in parallel by per-device writer threads. See writers.py.
+#   For asyncio applications, aio27gn950.py provides coroutine versions of
+#     find_monitors and the send functions.
+#
+#
+# Calibration:
+#   Colors sent to a monitor with a calibration profile (see calibration.py)
+#     are corrected for it: set color commands and video sync frames alike.
+#     The device state keeps the requested, uncalibrated colors.
+#
+#
+# Flow control:
+#   Every report is written within a per-device rate limit, so that no caller
+#     can write faster than the monitor's firmware takes it. Commands wait for
+#     the budget; video sync frames wait, are dropped or are coalesced,
+#     depending on the policy. See flowcontrol.py.
+#
+#
+# Metrics:
+#   metrics.enable() makes the send functions count and time every command
+#     per device. See metrics.py, also for serving the metrics over HTTP with
+#     the LIB27GN950_METRICS_PORT environment variable.
+#
+#
 #
 # control_commands
 #   This is a dictionary of commands. Pass the values to send_command. Example:
@@ -72,19 +165,66 @@ import hid
 #     send_command(brightness_commands[12], dev) # set to max brightness
 #
 #
+# control_frames   brightness_frames
+#   The same dictionaries as above, with every command already compiled into
+#     a `bytes` report. Pass the values to send_frames.
+#
+#
 # get_set_color_command(slot, color)
 #   Get the command to set the color for a static color slot
 #   `slot` must be an integer in the range [1..4]
 #   `color` must be a color string (described below)
 #   Example:
 #     Set static color slot 2 to a bluish red, with a bit of green mixed in
-#     send_command(get_set_color_command(2, 'ff20e0', dev))
+#     send_command(get_set_color_command(2, 'ff20e0'), dev)
+#   Results are cached, so asking for the same slot/color again is free.
+#   The color is calibrated for each device as the command is written (see
+#     Calibration below), so the command itself doesn't depend on the device.
 #
 #
 #
-# send_video_sync_data(colors, dev)
+# send_video_sync_data(colors, dev, force=False)
 #   Send a video sync data frame
 #   `colors` must be a list of 48 color strings
+#   A frame identical to the last one sent to a device is skipped, unless
+#     `force` is True.
+#
+#
+# send_video_sync_frame(colors, dev, encoder=None, force=False)
+#   Send a video sync data frame given as binary RGB data (requires NumPy)
+#   Identical frames are skipped in the same way as send_video_sync_data.
+#   `colors` must be 144 bytes of RGB data: a (48, 3) uint8 NumPy array, or
+#     any other contiguous buffer such as bytes or a memoryview
+#   `dev` must be an open hid.Device instance, or an iterable of them
+#   Unlike send_video_sync_data, no strings are built. The three reports are
+#     encoded in place into a buffer that is allocated once, by the
+#     VideoSyncEncoder passed as `encoder` (a shared one by default).
+#
+#
+# send_video_sync_frames(frames, force=False, synchronized=False)
+#   Send a different video sync frame to each device, in parallel
+#   `frames` is a dictionary (or an iterable of pairs) mapping each open
+#     hid.Device instance to its colors, as for send_video_sync_frame
+#   A monitor shows a frame once its last report arrives. If `synchronized`
+#     is True, the first two reports are written to every device, and the
+#     last ones are held back by a barrier until all devices are ready, so the
+#     monitors change together instead of one after another.
+#   Returns the skew: the time in seconds between the first and the last
+#     device finishing its frame (None for fewer than two devices). With
+#     metrics enabled, it is also added to metrics.video_sync_skew.
+#
+#
+# VideoSyncEncoder()
+#   Encodes binary video sync frames in place. encode(colors, profile=None)
+#     returns the three reports, which stay valid until the next call to
+#     encode(). `profile` is a calibration.Profile to apply to the colors.
+#     key() returns a hash identifying the most recently encoded frame.
+#
+#
+# send_video_sync_reports(reports, key, dev, force=False)
+#   Write the reports returned by VideoSyncEncoder.encode(), skipping devices
+#     whose last video sync frame had the same `key` (unless `force` is True).
+#     This is what send_video_sync_frame does after encoding.
 #
 #
 #
@@ -126,15 +266,135 @@ brightness_commands = {
 
 ################################################################################
 
+# Every report starts with this header and ends with this trailer, and is
+#   zero-padded to 64 bytes
+command_header = '5343c'
+command_end = '4544'
+report_size = 64
+
+# hidapi on Windows drops the first byte of every write, so each report is
+#   prefixed with a zero byte there. This is decided once, at import time.
+report_prefix = b'\x00' if 'Windows' in platform.system() else b''
+
+
+def encode_report(cmd):
+	report = bytes.fromhex(cmd)
+	if len(report) > report_size:
+		raise ValueError(f'encode_report: command is longer than {report_size} bytes')
+	return report_prefix + report.ljust(report_size, b'\x00')
+
+@lru_cache(maxsize=1024)
+def compile_raw_command(cmd):
+	return encode_report(cmd)
+
+@lru_cache(maxsize=1024)
+def compile_command(cmd):
+	return encode_report(command_header + cmd + command_end)
+
+
+control_frames = {k: compile_command(v) for k, v in control_commands.items()}
+brightness_frames = {k: compile_command(v) for k, v in brightness_commands.items()}
+
+
+################################################################################
+
+@lru_cache(maxsize=1024)
 def get_set_color_command(slot, color):
 	if slot not in [1,2,3,4]:
 		raise ValueError('get_set_color_command: slot must be an integer in the range [1..4]')
 
 	cmd_data = f'0{slot}{color}'
 	cmd = 'd0204' + cmd_data
-	cmd_with_header = '5343c' + cmd
+	crc = _set_color_crc.copy().update(bytes.fromhex(cmd_data))
 
-	return cmd + calc_crc(cmd_with_header)
+	return cmd + crc.hexdigest()
+
+# the CRC covers the header too, so hash the fixed part once
+_set_color_crc = Crc8(bytes.fromhex(command_header + 'd0204'))
+
+################################################################################
+################################################################################
+
+
+class DeviceState:
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.power = None
+		self.mode = None
+		self.brightness = None
+		self.colors = [None] * 4
+		self.video_sync = None
+
+	def is_redundant(self, effect):
+		# `effect` is the result of frame_effect(); None means unknown
+		if effect is None:
+			return False
+		field, value = effect
+		if field == 'power':
+			return self.power == value
+		if field == 'mode':
+			return self.power is True and self.mode == value
+		if field == 'brightness':
+			return self.brightness == value
+		slot, color = value
+		return self.colors[slot-1] == color
+
+	def apply(self, effect):
+		if effect is None:
+			self.reset()
+			return
+		field, value = effect
+		if field == 'power':
+			self.power = value
+		elif field == 'mode':
+			# selecting a mode also turns the lighting on
+			self.power = True
+			self.mode = value
+			self.video_sync = None
+		elif field == 'brightness':
+			self.brightness = value
+		else:
+			slot, color = value
+			self.colors[slot-1] = color
+
+
+_device_states = WeakKeyDictionary()
+
+def device_state(dev):
+	state = _device_states.get(dev)
+	if state is None:
+		state = _device_states.setdefault(dev, DeviceState())
+	return state
+
+
+_known_effects = {}
+for _name, _frame in control_frames.items():
+	if _name == 'turn_on':
+		_known_effects[_frame] = ('power', True)
+	elif _name == 'turn_off':
+		_known_effects[_frame] = ('power', False)
+	else:
+		_known_effects[_frame] = ('mode', _name)
+for _level, _frame in brightness_frames.items():
+	_known_effects[_frame] = ('brightness', _level)
+
+_set_color_start = bytes.fromhex(command_header + 'd0204')
+_set_color_end = bytes.fromhex(command_end)
+
+@lru_cache(maxsize=1024)
+def frame_effect(frame):
+	# what a compiled report does to the device state, or None if unknown
+	effect = _known_effects.get(frame)
+	if effect is not None:
+		return effect
+	report = frame[len(report_prefix):]
+	if report.startswith(_set_color_start) and report[10:12] == _set_color_end:
+		slot = report[5]
+		if slot in (1, 2, 3, 4):
+			return ('color', (slot, report[6:9].hex()))
+	return None
 
 ################################################################################
 ################################################################################
@@ -160,33 +420,161 @@ def find_monitors():
 				'serial': device['serial_number'],
 				'model': model,
 			})
+	if virtual_backend is not None:
+		device_paths.extend(virtual_backend.find_monitors())
 	return device_paths
 
+def open_device(path):
+	if virtual_backend is not None and path.startswith(virtual_backend.path_prefix):
+		return virtual_backend.open_device(path)
+	return hid.Device(path=path)
+
+# set by emulator.install(), see emulator.py
+virtual_backend = None
+
 ################################################################################
 
-def send_raw_command(cmd, dev):
-	if not hasattr(dev, '__iter__'):
-		dev = (dev,)
-	for _dev in dev:
-		send_str(cmd, _dev)
+def send_raw_command(cmd, dev, force=False):
+	send_frames(compile_raw_command(cmd), dev, force)
 
 ################################################################################
 
-def send_command(cmd, dev):
-	header = '5343c'
-	end = '4544'
+def send_command(cmd, dev, force=False):
 	if type(cmd) == str:
 		cmd = (cmd,)
+	send_frames([compile_command(_cmd) for _cmd in cmd], dev, force)
+
+def send_device_commands(commands, force=False):
+	jobs = {}
+	for dev, cmd in dict(commands).items():
+		if type(cmd) == str:
+			cmd = (cmd,)
+		jobs[dev] = _frames_job([compile_command(_cmd) for _cmd in cmd], force)
+	if jobs:
+		writers.fan_out(lambda _dev: jobs[_dev](_dev), tuple(jobs))
+
+################################################################################
+
+def send_frames(frames, dev, force=False):
+	writers.fan_out(_frames_job(frames, force), _device_list(dev))
+
+def send_video_sync_reports(reports, key, dev, force=False):
+	writers.fan_out(_video_sync_job(reports, key, force), _device_list(dev))
+
+# jobs are run by writers.fan_out once per device, with the device locked
+
+def _frames_job(frames, force):
+	if type(frames) == bytes:
+		frames = (frames,)
+	effects = [frame_effect(frame) for frame in frames]
+
+	def job(_dev):
+		state = device_state(_dev)
+		m = metrics.device_metrics(_dev) if metrics.enabled else None
+		profile = calibration.device_profile(_dev) if calibration.active else None
+		flow = flowcontrol.device_flow(_dev) if flowcontrol.enabled else None
+		for frame, effect in zip(frames, effects):
+			if force or not state.is_redundant(effect):
+				if profile is not None and effect is not None and effect[0] == 'color':
+					frame = _calibrated_color_frame(effect[1], profile)
+				if flow is not None:
+					flow.acquire(_dev, 1)
+					started = time.perf_counter()
+				if m is None:
+					_dev.write(frame)
+				else:
+					m.write(_dev, (frame,))
+				if flow is not None and flow.limit.ack:
+					flow.acknowledge(_dev, 1, started)
+				state.apply(effect)
+			elif m is not None:
+				m.skipped += 1
+	return job
+
+def _video_sync_job(reports, key, force, barrier=None, committed=None):
+	# with a `barrier`, the last report is only written once every device has
+	#   written the others; `committed` collects when each device finished
+	writes = reports
+	if barrier is not None:
+		writes = _BarrierReports(reports, barrier)
+
+	def job(_dev):
+		state = device_state(_dev)
+		m = metrics.device_metrics(_dev) if metrics.enabled else None
+		flow = flowcontrol.device_flow(_dev) if flowcontrol.enabled else None
+		if force or state.video_sync != key:
+			if flow is not None:
+				# if flow control holds the frame back, it is written on its own later
+				retry = None if flow.limit.policy == 'block' else _retry_job(reports, key, force)
+				if not flow.acquire(_dev, len(reports), retry):
+					# dropped or coalesced
+					if barrier is not None:
+						_barrier_wait(barrier)
+					return
+				started = time.perf_counter()
+			try:
+				if m is None:
+					for report in writes:
+						_dev.write(report)
+				else:
+					m.write(_dev, writes, video_sync=True)
+			except BaseException:
+				if barrier is not None:
+					# don't keep the other devices waiting
+					barrier.abort()
+				raise
+			if committed is not None:
+				committed.append(time.perf_counter())
+			if flow is not None and flow.limit.ack:
+				flow.acknowledge(_dev, len(reports), started)
+			state.video_sync = key
+		else:
+			if barrier is not None:
+				_barrier_wait(barrier)
+			if m is not None:
+				m.skipped += 1
+	return job
+
+def _retry_job(reports, key, force):
+	# the reports may be views into an encoder's buffer (or a sequence file's
+	#   mapping), and the next frame is encoded into it before a held back one
+	#   is written, so the retry writes a copy
+	return _video_sync_job(tuple(bytes(report) for report in reports), key, force)
+
+class _BarrierReports:
+	# iterates over the reports, waiting at the barrier before the last one
+	def __init__(self, reports, barrier):
+		self.reports = reports
+		self.barrier = barrier
+
+	def __iter__(self):
+		yield from self.reports[:-1]
+		_barrier_wait(self.barrier)
+		yield self.reports[-1]
+
+def _barrier_wait(barrier):
+	try:
+		barrier.wait()
+	except BrokenBarrierError:
+		# a device failed or is stuck: write anyway, just not in sync
+		pass
+
+# how long a device waits at the barrier for the others
+barrier_timeout = 0.5
+
+@lru_cache(maxsize=1024)
+def _calibrated_color_frame(slot_color, profile):
+	slot, color = slot_color
+	return compile_command(get_set_color_command(slot, profile.color(color)))
+
+def _device_list(dev):
 	if not hasattr(dev, '__iter__'):
-		dev = (dev,)
-	for _dev in dev:
-		for _cmd in cmd:
-			padding = '0'*(119-len(_cmd)) # 128 chars - '5343c' - '4544' = 119
-			send_str(header + _cmd + end + padding, _dev)
+		return (dev,)
+	return tuple(dev)
 
 ################################################################################
 
-def send_video_sync_data(colors, dev):
+def send_video_sync_data(colors, dev, force=False):
 	if len(colors) != 48:
 		raise ValueError('send_video_sync_data: must provide 48 colors')
 
@@ -202,20 +590,147 @@ def send_video_sync_data(colors, dev):
 		else: newcolor += color[4:6]
 		newcolors.append(newcolor)
 
+	color_bytes = bytes.fromhex(''.join(newcolors))
+	groups = calibration.device_groups(_device_list(dev))
+	if groups is None:
+		_send_video_sync_bytes(color_bytes, dev, force)
+		return
+	for profile, devs in groups:
+		_send_video_sync_bytes(profile.apply_bytes(color_bytes) if profile is not None else color_bytes, devs, force)
+
+def _send_video_sync_bytes(color_bytes, dev, force):
 	# generate the full command
-	cmd = '5343c1029100'
-	cmd += ''.join(newcolors)
-	cmd += calc_crc(cmd)
-	cmd += '4544'
+	colors = color_bytes.hex()
+	cmd = video_sync_header + colors
+	cmd += _video_sync_crc.copy().update(color_bytes).hexdigest()
+	cmd += command_end
 
 	# split into three 64 byte (128 char) commands
 	cmd1 = cmd[:128]
 	cmd2 = cmd[128:256]
 	cmd3 = cmd[256:] + '0'*78 # pad with zeroes to get to 64 bytes / 128 chars
 
-	send_raw_command(cmd1, dev)
-	send_raw_command(cmd2, dev)
-	send_raw_command(cmd3, dev)
+	# video sync frames are rarely repeated, so don't fill the command cache
+	reports = (encode_report(cmd1), encode_report(cmd2), encode_report(cmd3))
+	send_video_sync_reports(reports, hash(color_bytes), dev, force)
+
+video_sync_header = command_header + '1029100'
+_video_sync_crc = Crc8(bytes.fromhex(video_sync_header))
+
+################################################################################
+
+class VideoSyncEncoder:
+	def __init__(self):
+		import numpy as np
+		self.np = np
+
+		prefix = len(report_prefix)
+		header = bytes.fromhex(video_sync_header)
+		self.header_crc = _video_sync_crc.digest()
+
+		# all three reports live in one ctypes buffer, which hidapi can write
+		#   from directly without copying it into a bytes object first
+		size = prefix + report_size
+		self.buffer = ctypes.create_string_buffer(3 * size)
+		self.reports = tuple(
+			(ctypes.c_char * size).from_buffer(self.buffer, i * size) for i in range(3)
+		)
+		view = np.frombuffer(self.buffer, dtype=np.uint8).reshape(3, size)[:, prefix:]
+
+		# byte offsets of the colors, within the 153 byte command and within
+		#   each of the three reports
+		#   report 1: header (6)  + colors[0:58]
+		#   report 2: colors[58:122]
+		#   report 3: colors[122:144] + crc (1) + end (2)
+		start = len(header)
+		colors_end = start + 144
+		self.colors = np.empty(144, dtype=np.uint8)
+		# indices into the lookup table of a calibration profile
+		self.lut_index = np.empty(144, dtype=np.uint16)
+		self.segments = []
+		for i in range(3):
+			lo = max(start, i * report_size)
+			hi = min(colors_end, (i+1) * report_size)
+			self.segments.append((
+				view[i, lo - i*report_size:hi - i*report_size],
+				self.colors[lo - start:hi - start],
+			))
+		view[0, :len(header)] = tuple(header)
+		self.crc_view = view[2, colors_end - 2*report_size:]
+		self.crc_view[1:3] = tuple(bytes.fromhex(command_end))
+
+	def encode(self, colors, profile=None):
+		np = self.np
+		if isinstance(colors, np.ndarray):
+			colors = colors.reshape(-1)
+		else:
+			colors = np.frombuffer(colors, dtype=np.uint8)
+		if colors.shape != (144,) or colors.dtype != np.uint8:
+			raise ValueError('VideoSyncEncoder: must provide 48 uint8 RGB colors (144 bytes)')
+
+		if profile is None:
+			# each RGB component must be at least 1, otherwise the monitor can 'crash'
+			np.maximum(colors, 1, out=self.colors)
+		else:
+			# the profile's tables already have a floor of at least 1
+			np.add(colors, calibration.channel_offsets(), out=self.lut_index)
+			np.take(profile.lut, self.lut_index, out=self.colors)
+
+		for view, part in self.segments:
+			view[:] = part
+		self.crc_view[0] = crc8(self.colors, self.header_crc)
+		return self.reports
+
+	def key(self):
+		# identifies the most recently encoded frame, for DeviceState.video_sync
+		return hash(self.colors.tobytes())
+
+
+_video_sync_encoder = None
+_video_sync_lock = Lock()
+
+def send_video_sync_frame(colors, dev, encoder=None, force=False):
+	global _video_sync_encoder
+	groups = calibration.device_groups(_device_list(dev))
+	if groups is not None:
+		# differently calibrated devices get different frames
+		send_video_sync_frames({_dev: colors for _dev in _device_list(dev)}, force)
+		return
+	if encoder is not None:
+		reports = encoder.encode(colors)
+		send_video_sync_reports(reports, encoder.key(), dev, force)
+		return
+	with _video_sync_lock:
+		if _video_sync_encoder is None:
+			_video_sync_encoder = VideoSyncEncoder()
+		reports = _video_sync_encoder.encode(colors)
+		send_video_sync_reports(reports, _video_sync_encoder.key(), dev, force)
+
+def send_video_sync_frames(frames, force=False, synchronized=False):
+	global _video_sync_encoder
+	frames = dict(frames)
+	barrier = None
+	if synchronized and len(frames) > 1:
+		barrier = Barrier(len(frames), timeout=barrier_timeout)
+	committed = []
+	# a different frame for every device, so each device gets its own job
+	jobs = {}
+	with _video_sync_lock:
+		if _video_sync_encoder is None:
+			_video_sync_encoder = VideoSyncEncoder()
+		for dev, colors in frames.items():
+			profile = calibration.device_profile(dev) if calibration.active else None
+			# the jobs run after the next frame has been encoded, so copy
+			reports = tuple(bytes(report) for report in _video_sync_encoder.encode(colors, profile))
+			jobs[dev] = _video_sync_job(reports, _video_sync_encoder.key(), force, barrier, committed)
+	writers.fan_out(lambda _dev: jobs[_dev](_dev), tuple(jobs))
+
+	if len(committed) < 2:
+		return None
+	skew = max(committed) - min(committed)
+	if metrics.enabled:
+		metrics.video_sync_skew.add(skew)
+	return skew
 
 
 ################################################################################
@@ -224,14 +739,8 @@ def send_video_sync_data(colors, dev):
 
 def send_str(s, dev):
 	# s should be a 128-character hex string (representing 64 bytes)
-
-	if 'Windows' in platform.system():
-		# work around a hidapi bug in Windows which drops the first byte
-		i = int('00'+s, 16)
-		dev.write(i.to_bytes(65, byteorder='big'))
-	else:
-		i = int(s, 16)
-		dev.write(i.to_bytes(64, byteorder='big'))
+	# it is always written, but still updates the device state
+	send_frames(compile_raw_command(s), dev, force=True)
 
 
 ################################################################################
@@ -239,22 +748,23 @@ def send_str(s, dev):
 
 
 def calc_crc(data):
-	# This is the standard CRC algorithm, with the paramaters tweaked to what's
-	# used here. This implementation is based off of:
-	#   https://gist.github.com/Lauszus/6c787a3bc26fea6e842dfb8296ebd630
-	data = bytearray.fromhex(data)
-	crc = 0
-	for bit in data:
-		crc ^= bit
-		for _ in range(8):
-			crc <<= 1
-			if crc & 0x100:
-				crc ^= 0x101
-	# trim off the '0x' that hex() adds, and pad with a leading 0 if needed
-	crc = hex(crc)[2:]
-	if len(crc) == 1:
-		return '0' + crc
-	return crc
+	# `data` is a hex string, the result is a 2-character hex string
+	# See crc8.py for the bytes-based (and incremental / batch) versions
+	return f'{crc8(bytes.fromhex(data)):02x}'
+
+
+################################################################################
+################################################################################
+
+# Virtual monitors for testing without hardware, see emulator.py
+
+if os.environ.get('LIB27GN950_EMULATE'):
+	import emulator # installs the monitors once it has been imported
+
+# Metrics endpoint, see metrics.py
+
+if os.environ.get('LIB27GN950_METRICS_PORT'):
+	metrics.serve(int(os.environ['LIB27GN950_METRICS_PORT']))
 
 
 ################################################################################
@@ -276,7 +786,7 @@ if __name__ == '__main__':
 
 	devs = []
 	for monitor in monitors:
-		dev = hid.Device(path=monitor['path'])
+		dev = open_device(monitor['path'])
 		print(f'Got monitor with serial number {dev.serial}')
 		devs.append(dev)
 
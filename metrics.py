@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+
+# Runtime metrics
+#
+# Metrics are disabled by default. While they are disabled, the write path
+#   only checks `metrics.enabled` once per command and device, so they cost
+#   nothing measurable. Once enabled, every command written by lib27gn950 is
+#   counted and timed per device, from its first USB write to its last.
+#
+# Video sync pipelines (videosync.VideoSync) always count the frames they
+#   produce, send and drop. While they exist, they are included in snapshot().
+#
+# To get the metrics out of a running program:
+#   - console.py: the `stats` command
+#   - gui.py: hover over a monitor's checkbox
+#   - MQTT bridge: set mqtt_stats_topic in config.ini, the snapshot is
+#     published there as JSON every mqtt_stats_interval seconds
+#   - any program: set the LIB27GN950_METRICS_PORT environment variable, and
+#     http://127.0.0.1:<port>/metrics serves the metrics in the Prometheus
+#     text format, and /metrics.json as JSON
+#
+#
+# API documentation:
+#
+# enable()   disable()
+#   Start / stop collecting the per-device metrics
+#
+# enabled
+#   True while metrics are being collected
+#
+#
+# device_metrics(dev)
+#   Return the DeviceMetrics for a device. Attributes:
+#     name              the serial number of the device, if it has one
+#     commands          commands written (a video sync frame is one command)
+#     video_sync_frames video sync frames written
+#     skipped           commands not written because they wouldn't change
+#                       anything (see lib27gn950.device_state)
+#     reports           64-byte reports written
+#     bytes             bytes written
+#     errors            commands that failed with an exception
+#     latency           a Histogram of the time taken by each command
+#   snapshot() also includes each device's flow control stats (see
+#     flowcontrol.py) as 'flow'.
+#
+#
+# video_sync_skew
+#   A Histogram of the time between the first and the last monitor showing
+#     the same multi-monitor frame (see lib27gn950.send_video_sync_frames)
+#
+#
+# Histogram(buckets=latency_buckets)
+#   count, sum, counts (one per bucket, plus one for larger values)
+#   percentile(fraction)
+#     Return the upper bound of the bucket containing that percentile
+#
+#
+# snapshot()
+#   Return all metrics as a dictionary that can be serialized to JSON:
+#     {'enabled': ..., 'devices': {name: {...}}, 'video_sync': [{...}, ...],
+#      'video_sync_skew': {...}}
+#
+# prometheus_text()
+#   Return all metrics in the Prometheus text exposition format
+#
+# reset()
+#   Forget the collected per-device metrics and skew
+#
+#
+# serve(port, host='127.0.0.1')
+#   Serve /metrics and /metrics.json over HTTP from a background thread, and
+#     return the http.server instance (call shutdown() on it to stop). Also
+#     enables the metrics.
+
+################################################################################
+
+import json
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from weakref import WeakKeyDictionary, WeakSet
+
+import flowcontrol
+
+
+enabled = False
+
+# upper bounds in seconds; a USB write usually takes around a millisecond
+latency_buckets = (
+	0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+	0.01, 0.025, 0.05, 0.1, 0.25, 1.0,
+)
+
+
+def enable():
+	global enabled
+	enabled = True
+
+def disable():
+	global enabled
+	enabled = False
+
+
+################################################################################
+################################################################################
+
+
+class Histogram:
+	def __init__(self, buckets=latency_buckets):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.count = 0
+		self.sum = 0.0
+
+	def add(self, value):
+		self.counts[bisect_left(self.buckets, value)] += 1
+		self.count += 1
+		self.sum += value
+
+	def percentile(self, fraction):
+		if not self.count:
+			return 0.0
+		target = fraction * self.count
+		seen = 0
+		for bound, count in zip(self.buckets, self.counts):
+			seen += count
+			if seen >= target:
+				return bound
+		return float('inf')
+
+	def as_dict(self):
+		return {
+			'count': self.count,
+			'sum': self.sum,
+			'buckets': {str(bound): count for bound, count in zip(self.buckets, self.counts)},
+			'overflow': self.counts[-1],
+		}
+
+
+class DeviceMetrics:
+	# updated by the write jobs, which run with the device locked, so the
+	#   counters don't need a lock of their own
+	def __init__(self, name):
+		self.name = name
+		self.commands = 0
+		self.video_sync_frames = 0
+		self.skipped = 0
+		self.reports = 0
+		self.bytes = 0
+		self.errors = 0
+		self.latency = Histogram()
+
+	def write(self, dev, reports, video_sync=False):
+		started = time.perf_counter()
+		try:
+			for report in reports:
+				dev.write(report)
+				self.reports += 1
+				self.bytes += len(report)
+		except BaseException:
+			self.errors += 1
+			raise
+		self.latency.add(time.perf_counter() - started)
+		self.commands += 1
+		if video_sync:
+			self.video_sync_frames += 1
+
+	def as_dict(self):
+		return {
+			'commands': self.commands,
+			'video_sync_frames': self.video_sync_frames,
+			'skipped': self.skipped,
+			'reports': self.reports,
+			'bytes': self.bytes,
+			'errors': self.errors,
+			'latency_p50_ms': self.latency.percentile(0.50) * 1000,
+			'latency_p99_ms': self.latency.percentile(0.99) * 1000,
+			'latency': self.latency.as_dict(),
+		}
+
+
+################################################################################
+
+_devices = WeakKeyDictionary()
+_devices_lock = Lock()
+
+# videosync.VideoSync instances add themselves here
+pipelines = WeakSet()
+
+video_sync_skew = Histogram()
+
+
+def device_metrics(dev):
+	m = _devices.get(dev)
+	if m is None:
+		with _devices_lock:
+			m = _devices.get(dev)
+			if m is None:
+				name = getattr(dev, 'serial', None) or f'device-{id(dev):x}'
+				m = _devices[dev] = DeviceMetrics(name)
+	return m
+
+def reset():
+	global video_sync_skew
+	with _devices_lock:
+		_devices.clear()
+		video_sync_skew = Histogram()
+
+
+################################################################################
+################################################################################
+
+
+def snapshot():
+	with _devices_lock:
+		devices = list(_devices.items())
+	return {
+		'enabled': enabled,
+		'devices': {m.name: dict(m.as_dict(), flow=flowcontrol.flow_stats(dev)) for dev, m in devices},
+		'video_sync': [pipeline.stats() for pipeline in list(pipelines)],
+		'video_sync_skew': dict(
+			video_sync_skew.as_dict(),
+			p50_ms=video_sync_skew.percentile(0.50) * 1000,
+			p99_ms=video_sync_skew.percentile(0.99) * 1000,
+		),
+	}
+
+
+_device_counters = (
+	('commands', 'Commands written'),
+	('video_sync_frames', 'Video sync frames written'),
+	('skipped', 'Commands skipped because they would not change anything'),
+	('reports', 'HID reports written'),
+	('bytes', 'Bytes written'),
+	('errors', 'Commands that failed'),
+)
+
+_flow_counters = (
+	('blocked', 'Writes that waited for the rate limit'),
+	('dropped', 'Video sync frames dropped by the rate limit'),
+	('coalesced', 'Video sync frames replaced by a newer one under the rate limit'),
+)
+
+def prometheus_text():
+	with _devices_lock:
+		items = list(_devices.items())
+	devices = [m for dev, m in items]
+	flows = [(m.name, flowcontrol.flow_stats(dev)) for dev, m in items]
+	flows = [(name, flow) for name, flow in flows if flow is not None]
+	lines = []
+
+	def metric(name, kind, help_text, samples):
+		lines.append(f'# HELP lib27gn950_{name} {help_text}')
+		lines.append(f'# TYPE lib27gn950_{name} {kind}')
+		for labels, value in samples:
+			label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+			lines.append(f'lib27gn950_{name}{{{label_text}}} {value}')
+
+	for field, help_text in _device_counters:
+		metric(f'{field}_total', 'counter', help_text,
+			[({'serial': m.name}, getattr(m, field)) for m in devices])
+
+	def histogram(name, h, label=''):
+		cumulative = 0
+		for bound, count in zip(h.buckets, h.counts):
+			cumulative += count
+			lines.append(f'lib27gn950_{name}_bucket{{{label}le="{bound}"}} {cumulative}')
+		lines.append(f'lib27gn950_{name}_bucket{{{label}le="+Inf"}} {h.count}')
+		label = label.rstrip(',')
+		lines.append(f'lib27gn950_{name}_sum{{{label}}} {h.sum}')
+		lines.append(f'lib27gn950_{name}_count{{{label}}} {h.count}')
+
+	for field, help_text in _flow_counters:
+		metric(f'flow_{field}_total', 'counter', help_text,
+			[({'serial': name}, flow[field]) for name, flow in flows])
+	metric('flow_rate', 'gauge', 'Current write rate limit in reports per second',
+		[({'serial': name}, flow['rate']) for name, flow in flows])
+
+	lines.append('# HELP lib27gn950_write_seconds Time taken to write a command')
+	lines.append('# TYPE lib27gn950_write_seconds histogram')
+	for m in devices:
+		histogram('write_seconds', m.latency, f'serial="{m.name}",')
+
+	lines.append('# HELP lib27gn950_video_sync_skew_seconds Time between the first and the last monitor showing a frame')
+	lines.append('# TYPE lib27gn950_video_sync_skew_seconds histogram')
+	histogram('video_sync_skew_seconds', video_sync_skew)
+
+	stats = [pipeline.stats() for pipeline in list(pipelines)]
+	for field, name in (('produced', 'produced'), ('frames', 'sent'), ('dropped', 'dropped')):
+		metric(f'video_sync_frames_{name}_total', 'counter', f'Video sync frames {name}',
+			[({'pipeline': i}, s[field]) for i, s in enumerate(stats)])
+	metric('video_sync_fps', 'gauge', 'Achieved video sync frames per second',
+		[({'pipeline': i}, s['fps']) for i, s in enumerate(stats)])
+	metric('video_sync_effective_fps', 'gauge', 'Frame rate the video sync pacing has adapted to',
+		[({'pipeline': i}, s['effective_fps']) for i, s in enumerate(stats)])
+	metric('video_sync_jitter_seconds', 'gauge', 'RMS deviation of the video sync frame times',
+		[({'pipeline': i}, s['jitter_ms'] / 1000) for i, s in enumerate(stats)])
+
+	return '\n'.join(lines) + '\n'
+
+
+################################################################################
+################################################################################
+
+
+class _Handler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path == '/metrics':
+			body = prometheus_text().encode()
+			content_type = 'text/plain; version=0.0.4'
+		elif self.path == '/metrics.json':
+			body = json.dumps(snapshot()).encode()
+			content_type = 'application/json'
+		else:
+			self.send_error(404)
+			return
+		self.send_response(200)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+
+def serve(port, host='127.0.0.1'):
+	enable()
+	server = ThreadingHTTPServer((host, port), _Handler)
+	server.daemon_threads = True
+	Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+	return server
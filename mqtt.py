@@ -1,10 +1,93 @@
+import json
+import random
+import re
 import time
 from dataclasses import dataclass
+from socket import gethostname
+from threading import Condition, Event, Thread, Timer
 
 import certifi
 import paho.mqtt.client as mqtt
 
 import lib27gn950 as bias
+import metrics
+import scenes
+
+# mode numbers as used by the monitor, for binary mode payloads
+mode_values = {
+    1: "color1",
+    2: "color2",
+    3: "color3",
+    4: "color4",
+    5: "color_peaceful",
+    6: "color_dynamic",
+    8: "color_video_sync",
+}
+
+frame_size = 48 * 3
+
+
+class Dispatcher:
+    # Runs message handlers on a worker thread, so that HID writes never block
+    # paho's network thread. At most one handler is pending per key (the MQTT
+    # topic): a newer message replaces the pending one. When `maxsize` keys
+    # are pending, messages for other keys are dropped.
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.condition = Condition()
+        self.pending = {}
+        self.counters = {
+            "received": 0,
+            "coalesced": 0,
+            "dropped": 0,
+            "handled": 0,
+            "errors": 0,
+        }
+        # from receiving a message to its handler finishing
+        self.latency = metrics.Histogram()
+        self.thread = Thread(target=self._run, name="mqtt-dispatch", daemon=True)
+        self.thread.start()
+
+    def submit(self, key, handler):
+        received = time.perf_counter()
+        with self.condition:
+            self.counters["received"] += 1
+            if key in self.pending:
+                self.counters["coalesced"] += 1
+                del self.pending[key]
+            elif len(self.pending) >= self.maxsize:
+                self.counters["dropped"] += 1
+                return False
+            self.pending[key] = (handler, received)
+            self.condition.notify()
+        return True
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending)
+                key = next(iter(self.pending))
+                handler, received = self.pending.pop(key)
+            try:
+                handler()
+            except Exception as e:
+                print(f"Error while handling an MQTT message: {e}")
+                with self.condition:
+                    self.counters["errors"] += 1
+                continue
+            latency = time.perf_counter() - received
+            with self.condition:
+                self.counters["handled"] += 1
+                self.latency.add(latency)
+
+    def stats(self):
+        with self.condition:
+            return dict(
+                self.counters,
+                pending=len(self.pending),
+                latency_p50_ms=self.latency.percentile(0.50) * 1000,
+                latency_p99_ms=self.latency.percentile(0.99) * 1000,
+            )
 
 
 @dataclass
@@ -18,68 +101,274 @@ class MQTT:
     mqtt_user: str
     mqtt_password: str
     mqtt_tls: str
+    mqtt_stats_topic: str = None
+    mqtt_stats_interval: int = 30
+    # a stable client id, so the broker keeps the session (and queues QoS 1
+    # commands) while we are reconnecting
+    mqtt_client_id: str = None
+    mqtt_turn_off_on_disconnect: bool = True
+    # seconds the connection has to stay down before the monitors are turned
+    # off, so a network blip doesn't turn them off
+    mqtt_disconnect_grace: float = 30
+    backoff_min: float = 1.0
+    backoff_max: float = 120.0
 
     def __post_init__(self):
-        self.client = mqtt.Client()
-        self.quit = False
-
-    def connect(self, mqtt_checkbox):
-        self.mqtt_checkbox = mqtt_checkbox
+        self.client_id = self.mqtt_client_id or f"27gn950controller-{gethostname()}"
+        self.client = mqtt.Client(client_id=self.client_id, clean_session=False)
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         self.client.on_disconnect = self.on_disconnect
-        self.client.will_set(self.mqtt_availability_topic, "offline", 0, False)
+        self.client.will_set(self.mqtt_availability_topic, "offline", 1, True)
         # https://stackoverflow.com/questions/70110392/mqtt-tls-certificate-verify-failed-self-signed-certificate
         if self.mqtt_tls:
             try:
                 self.client.tls_set(certifi.where())
             except ValueError:
                 pass
-
         self.client.username_pw_set(self.mqtt_user, self.mqtt_password)
 
-        while True:
-            if mqtt_checkbox.checkState() == 0 or self.quit:
-                return
+        # called with True / False when the connection goes up / down, from
+        # the connection thread
+        self.on_status = lambda connected: None
+        self.thread = None
+        self.stop_event = Event()
+        self.backoff = self.backoff_min
+        self.turn_off_timer = None
+        # only used from the dispatcher thread
+        self.effect = None
+        self.dispatcher = Dispatcher()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stop_event = Event()
+        self.thread = Thread(target=self.run, args=(self.stop_event,), daemon=True)
+        self.thread.start()
+        if self.mqtt_stats_topic:
+            Thread(
+                target=self.publish_stats, args=(self.stop_event,), daemon=True
+            ).start()
 
+    def stop(self):
+        if self.thread is None:
+            return
+        print("Disconnect")
+        self.stop_event.set()
+        if self.turn_off_timer is not None:
+            self.turn_off_timer.cancel()
+        if self.client.is_connected():
+            self.client.publish(self.mqtt_availability_topic, "offline", 1, True)
+            self.client.disconnect()
+        self.thread.join()
+        self.thread = None
+
+    def run(self, stop):
+        # connect, run the network loop until the connection is lost, wait,
+        # and try again, until stop() is called
+        while not stop.is_set():
             try:
-                if not self.client.is_connected():
-                    self.client.connect(self.host, self.port, 60)
-                    self.client.loop_forever()
-                else:
+                self.client.connect(self.host, self.port, 60)
+            except Exception as e:
+                print(f"MQTT connection failed: {e}")
+            else:
+                rc = mqtt.MQTT_ERR_SUCCESS
+                while rc == mqtt.MQTT_ERR_SUCCESS:
+                    rc = self.client.loop(1.0)
+                if stop.is_set():
                     return
+            self.on_status(False)
 
-            except Exception as e:
-                print(e)
+            # exponential backoff, with full jitter so that a broker restart
+            # doesn't get every client reconnecting at the same moment
+            delay = random.uniform(0, self.backoff)
+            self.backoff = min(self.backoff * 2, self.backoff_max)
+            print(f"MQTT reconnecting in {delay:.1f} s")
+            stop.wait(delay)
 
-                mqtt_checkbox.setDisabled(True)
-                time.sleep(5)
+    def on_connect(self, client, userdata, flags, rc):
+        print("Connected with result code " + str(rc))
+        if rc != 0:
+            return
+        self.backoff = self.backoff_min
+        if self.turn_off_timer is not None:
+            self.turn_off_timer.cancel()
+            self.turn_off_timer = None
 
-    def disconnect(self, force=False):
-        if force:
-            self.quit = True
+        # with a resumed session the broker still has the subscription, but
+        # subscribing again is harmless
+        client.subscribe(f"{self.mqtt_command_topic}/#", 1)
+        client.publish(self.mqtt_availability_topic, "online", 1, True)
+        self.on_status(True)
 
-        print("Disconnect")
+    def publish_stats(self, stop):
+        while not stop.wait(self.mqtt_stats_interval):
+            if self.client.is_connected():
+                stats = dict(metrics.snapshot(), mqtt=self.dispatcher.stats())
+                self.client.publish(self.mqtt_stats_topic, json.dumps(stats))
 
-        self.client.publish(self.mqtt_availability_topic, "offline")
-        self.client.disconnect()
+    def connected_devs(self):
+        return [dev for dev in self.devs if getattr(dev, "connected", True)]
 
-    def on_connect(self, client, userdata, flags, rc):
-        print("Connected with result code " + str(rc))
+    def on_message(self, client, userdata, msg):
+        # runs on paho's network thread, the writes happen on the dispatcher's
+        self.dispatcher.submit(msg.topic, lambda: self.handle_message(msg))
 
-        client.subscribe(f"{self.mqtt_command_topic}/#")
-        client.publish(self.mqtt_availability_topic, "online")
-        self.mqtt_checkbox.setDisabled(False)
+    def device(self, serial):
+        for dev in self.connected_devs():
+            if dev.serial == serial:
+                return dev
+        raise ValueError(f"no connected monitor with serial {serial!r}")
 
-    def on_message(self, client, userdata, msg):
-        match msg.payload.decode():
+    def handle_message(self, msg):
+        # topics relative to mqtt_command_topic:
+        #   (none)           "on" / "off"
+        #   brightness       1 byte, or text, 1..12
+        #   mode             1 byte (see mode_values), or a control_commands name
+        #   color/<slot>     3 bytes RGB, or 6 hex characters
+        #   frames           144 bytes RGB video sync frame, for all monitors
+        #   frames/<serial>  the same, for one monitor
+        #   batch            a video sync frame for each of several monitors:
+        #                    [serial length (1 byte)][serial][144 bytes RGB]...
+        #   effect           a software effect: its name, or a JSON object
+        #                    {"name": ..., "speed": ..., "brightness": ...,
+        #                    "palette": [...], "fps": ...}; "off" stops it
+        #   scene            apply a scene, by name (see scenes.py)
+        #   scene/save       save what the monitors show as a scene, by name
+        #   (any other)      "on" / "off", as for the command topic itself
+        topic = msg.topic[len(self.mqtt_command_topic) :].strip("/").split("/")
+        payload = msg.payload
+        if topic == ["scene"] or topic[0] in ["", "mode", "frames", "batch", "effect"]:
+            # these replace whatever the effect is showing
+            self.stop_effect()
+        match topic:
+            case [""]:
+                self.handle_power(payload.decode())
+            case ["brightness"]:
+                brightness = int(payload) if payload.isdigit() else payload[0]
+                bias.send_command(
+                    bias.brightness_commands[brightness], self.connected_devs()
+                )
+            case ["mode"]:
+                mode = (
+                    mode_values[payload[0]] if len(payload) == 1 else payload.decode()
+                )
+                bias.send_command(bias.control_commands[mode], self.connected_devs())
+            case ["color", slot]:
+                bias.send_command(
+                    bias.get_set_color_command(
+                        self.parse_slot(slot), self.parse_color(payload)
+                    ),
+                    self.connected_devs(),
+                )
+            case ["frames"]:
+                self.send_frames({dev: payload for dev in self.connected_devs()})
+            case ["frames", serial]:
+                self.send_frames({self.device(serial): payload})
+            case ["batch"]:
+                self.send_frames(self.parse_batch(payload))
+            case ["effect"]:
+                self.start_effect(payload.decode())
+            case ["scene"]:
+                scenes.apply(payload.decode(), self.connected_devs())
+            case ["scene", "save"]:
+                scenes.save(payload.decode(), self.connected_devs())
+            case _ if payload in [b"on", b"off"]:
+                # power used to be accepted on any topic, keep that working
+                self.stop_effect()
+                self.handle_power(payload.decode())
+            case _:
+                raise ValueError(f"unknown topic {msg.topic}")
+
+    def parse_slot(self, slot):
+        if slot not in ["1", "2", "3", "4"]:
+            raise ValueError(f"color slot must be 1 to 4, not {slot!r}")
+        return int(slot)
+
+    def parse_color(self, payload):
+        # anything else would make a malformed set color report
+        if len(payload) == 3:
+            return payload.hex()
+        color = payload.decode(errors="replace")
+        if not re.fullmatch(r"[0-9a-fA-F]{6}", color):
+            raise ValueError(
+                f"color must be 3 bytes RGB or 6 hex characters, not {payload!r}"
+            )
+        return color.lower()
+
+    def handle_power(self, payload):
+        match payload:
             case "on":
-                bias.send_command(bias.control_commands["turn_on"], self.devs)
-                client.publish(self.mqtt_contact_topic, "on")
+                bias.send_command(
+                    bias.control_commands["turn_on"], self.connected_devs()
+                )
+                # only acknowledged once the monitors have been written to
+                self.client.publish(self.mqtt_contact_topic, "on", 1, True)
             case "off":
-                bias.send_command(bias.control_commands["turn_off"], self.devs)
-                client.publish(self.mqtt_contact_topic, "off")
+                bias.send_command(
+                    bias.control_commands["turn_off"], self.connected_devs()
+                )
+                self.client.publish(self.mqtt_contact_topic, "off", 1, True)
+
+    def start_effect(self, payload):
+        import effects
+
+        if payload in ["", "off"]:
+            return
+        params = json.loads(payload) if payload.startswith("{") else {"name": payload}
+        name = params.pop("name")
+        fps = params.pop("fps", 60)
+        if type(fps) not in [int, float] or not 1 <= fps <= 120:
+            raise ValueError(f"effect fps must be 1 to 120, not {fps!r}")
+        self.effect = effects.play(
+            effects.create(name, **params), self.connected_devs(), fps
+        )
+
+    def stop_effect(self):
+        if self.effect is not None:
+            self.effect.stop()
+            self.effect = None
+
+    def parse_batch(self, payload):
+        frames = {}
+        view = memoryview(payload)
+        i = 0
+        while i < len(view):
+            length = view[i]
+            serial = bytes(view[i + 1 : i + 1 + length]).decode()
+            i += 1 + length
+            frame = view[i : i + frame_size]
+            if len(frame) != frame_size:
+                raise ValueError("truncated batch payload")
+            i += frame_size
+            frames[self.device(serial)] = frame
+        return frames
+
+    def send_frames(self, frames):
+        for frame in frames.values():
+            if len(frame) != frame_size:
+                raise ValueError(f"video sync frames must be {frame_size} bytes")
+        # already in video sync mode after the first frame, so this is skipped
+        bias.send_command(bias.control_commands["color_video_sync"], list(frames))
+        bias.send_video_sync_frames(frames)
 
     def on_disconnect(self, client, userdata, rc):
-        bias.send_command(bias.control_commands["turn_off"], self.devs)
-        self.mqtt_checkbox.setDisabled(True)
+        self.on_status(False)
+        if not self.mqtt_turn_off_on_disconnect:
+            return
+        if rc == 0:
+            # stop() was called
+            self.turn_off()
+        elif self.turn_off_timer is None:
+            self.turn_off_timer = Timer(self.mqtt_disconnect_grace, self.turn_off)
+            self.turn_off_timer.daemon = True
+            self.turn_off_timer.start()
+
+    def turn_off(self):
+        self.turn_off_timer = None
+        # same key as the command topic, so it replaces a pending "on"
+        self.dispatcher.submit(self.mqtt_command_topic, self.handle_turn_off)
+
+    def handle_turn_off(self):
+        self.stop_effect()
+        bias.send_command(bias.control_commands["turn_off"], self.connected_devs())
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+# Frame pacing for video sync streams
+#
+# Sleeping for a fixed time between frames drifts (every sleep overshoots a
+#   little, and the time spent on the frame itself adds up), and when a write
+#   is slow the stream either stalls or catches up with a burst of frames.
+#   FramePacer instead:
+#   - schedules frames at fixed times on a monotonic clock, so oversleeping or
+#     a slow frame never shifts the frames after it
+#   - when it falls behind by whole frames, drops their time slots instead of
+#     sending them late, so the next frame sent is always a fresh one
+#   - measures how long each frame takes to produce and write, and lowers the
+#     frame rate when that doesn't fit in the frame time, raising it again
+#     (gradually) when it does
+#
+#
+# API documentation:
+#
+# FramePacer(fps, min_fps=None, adaptive=True)
+#   `fps` is the target frame rate
+#   `min_fps` is the lowest rate to adapt down to, a quarter of `fps` by
+#     default. If `adaptive` is False, the rate stays at `fps`.
+#   wait()
+#     Sleep until it's time for the next frame
+#   frame_done(busy)
+#     Report that the frame took `busy` seconds to produce and write
+#   stats()
+#     Return a dictionary with the target fps, the current (adapted) fps, the
+#       achieved fps, the number of dropped frames and rate adjustments, and
+#       the jitter: the RMS difference in ms between the time from one frame
+#       to the next and the frame time
+#   reset()
+#     Start over, e.g. after a pause
+#
+#   A pacing loop looks like:
+#     pacer = FramePacer(60)
+#     while True:
+#       pacer.wait()
+#       started = time.perf_counter()
+#       ... produce and send a frame ...
+#       pacer.frame_done(time.perf_counter() - started)
+
+################################################################################
+
+import math
+import time
+
+
+class FramePacer:
+	# lower the rate when frames take more than this part of the frame time...
+	busy_high = 0.9
+	# ...and raise it when they'd take less than this part at the higher rate
+	busy_low = 0.6
+	# seconds to wait after a change before raising the rate
+	raise_delay = 1.0
+
+	def __init__(self, fps, min_fps=None, adaptive=True):
+		self.target_fps = fps
+		self.min_fps = min(fps, min_fps or max(1.0, fps / 4))
+		self.adaptive = adaptive
+		self.clock = time.perf_counter
+		self.reset()
+
+	def reset(self):
+		self.fps = self.target_fps
+		self.period = 1 / self.fps
+		self.anchor = None
+		self.index = 0
+		self.busy = None
+		self.changed = 0.0
+		self.frames = 0
+		self.dropped = 0
+		self.adjustments = 0
+		self.first = None
+		self.last = None
+		self.deviation = 0.0
+
+	def wait(self):
+		now = self.clock()
+		if self.anchor is None:
+			self.anchor = self.first = now
+		else:
+			self.index += 1
+			deadline = self.anchor + self.index * self.period
+			if now < deadline:
+				time.sleep(deadline - now)
+				now = self.clock()
+			else:
+				# skip the time slots that have already passed entirely
+				missed = int((now - deadline) / self.period)
+				self.index += missed
+				self.dropped += missed
+			# the deviation from the frame time, for the jitter
+			self.deviation += (now - self.last - self.period) ** 2
+		self.last = now
+		self.frames += 1
+
+	def frame_done(self, busy):
+		self.busy = busy if self.busy is None else self.busy * 0.9 + busy * 0.1
+		if not self.adaptive:
+			return
+		now = self.clock()
+		if self.busy > self.busy_high * self.period and self.fps > self.min_fps:
+			self._set_fps(max(self.min_fps, self.busy_low / self.busy))
+		elif self.fps < self.target_fps and now - self.changed > self.raise_delay:
+			higher = min(self.target_fps, self.fps * 1.25)
+			if self.busy < self.busy_low / higher:
+				self._set_fps(higher)
+
+	def _set_fps(self, fps):
+		# re-anchor at the current frame, so the change doesn't move it
+		self.anchor += self.index * self.period
+		self.index = 0
+		self.fps = fps
+		self.period = 1 / fps
+		self.changed = self.clock()
+		self.adjustments += 1
+
+	def stats(self):
+		elapsed = self.last - self.first if self.frames > 1 else 0.0
+		return {
+			'target_fps': self.target_fps,
+			'effective_fps': self.fps,
+			'achieved_fps': (self.frames - 1) / elapsed if elapsed > 0 else 0.0,
+			'dropped': self.dropped,
+			'adjustments': self.adjustments,
+			'jitter_ms': math.sqrt(self.deviation / (self.frames - 1)) * 1000 if self.frames > 1 else 0.0,
+		}
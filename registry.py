@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+
+# Registry of connected monitors
+#
+# hid.enumerate() walks every HID device on the system, which can take tens of
+#   milliseconds on a dock with many devices, and a hid.Device goes stale when
+#   its monitor is unplugged or re-enumerated. The registry takes care of both:
+#   - enumeration results are cached for `ttl` seconds
+#   - monitors are keyed by serial number (stable, unlike HID paths), and their
+#     handles are opened once and kept open
+#   - refresh() reconciles the open handles with the connected monitors; it
+#     can be run periodically on a background thread with start_polling()
+#   - a write that fails reopens the monitor (by serial) and is retried once
+#
+#
+# API documentation:
+#
+# DeviceRegistry(ttl=2.0)
+#   devices(refresh=False)
+#     Return the connected monitors, as RegisteredDevice objects, in the order
+#       they were first seen. Enumerates only the first time (or if `refresh`).
+#   get(serial)
+#     Return the RegisteredDevice with the given serial, or None
+#   enumerate(refresh=False)
+#     Return the (cached) result of lib27gn950.find_monitors()
+#   refresh(force=False)
+#     Reconcile the open handles with the connected monitors, and return the
+#       lists of (added, removed) RegisteredDevices. Uses the cached
+#       enumeration unless it is older than `ttl` or `force` is True.
+#   add_listener(callback)
+#     Call callback(added, removed) whenever refresh() finds changes. The
+#       callback runs on the thread that called refresh().
+#   start_polling(interval=5.0)   stop_polling()
+#     Run refresh() every `interval` seconds on a background thread
+#   close()
+#     Stop polling, and close all writer threads and handles
+#
+#
+# RegisteredDevice
+#   Can be used anywhere a hid.Device is expected. The object stays the same
+#     across reconnects, so it can be kept in lists, and lib27gn950's device
+#     state and writer threads follow the monitor rather than the handle.
+#   Attributes: serial, model, path, connected
+#
+#
+# default_registry()
+#   Return a registry shared by the whole process (console, GUI, MQTT bridge).
+#     Creating it also loads the color calibration profiles and the write
+#     rate limits, see calibration.py and flowcontrol.py.
+
+################################################################################
+
+import time
+from threading import Event, Lock, Thread
+
+import hid
+
+import calibration
+import flowcontrol
+import lib27gn950
+import writers
+
+
+hid_errors = (OSError, hid.HIDException)
+
+
+def open_device(monitor):
+	return lib27gn950.open_device(monitor['path'])
+
+
+def monitor_key(monitor):
+	# some devices don't report a serial number, fall back to the path
+	return monitor['serial'] or monitor['path']
+
+
+################################################################################
+################################################################################
+
+
+class RegisteredDevice:
+	def __init__(self, registry, monitor):
+		self.registry = registry
+		self.key = monitor_key(monitor)
+		self.serial = monitor['serial']
+		self.model = monitor['model']
+		self.path = monitor['path']
+		self.dev = None
+		self.connected = False
+
+	def __repr__(self):
+		state = 'connected' if self.connected else 'disconnected'
+		return f'<RegisteredDevice {self.serial or self.path!r} {self.model} {state}>'
+
+	def write(self, data):
+		dev = self.dev
+		if dev is not None:
+			try:
+				return dev.write(data)
+			except hid_errors:
+				pass
+		if not self.registry.reopen(self):
+			raise OSError(f'monitor {self.serial or self.path!r} is not connected')
+		return self.dev.write(data)
+
+	def read(self, size, timeout=None):
+		if self.dev is None:
+			raise OSError(f'monitor {self.serial or self.path!r} is not connected')
+		return self.dev.read(size, timeout)
+
+	def close(self):
+		self._set_handle(None, None)
+		writers.close_writer(self)
+
+	def _set_handle(self, dev, path):
+		# swap handles with the device locked, so no write is using the old one
+		with writers.get_writer(self).lock:
+			old = self.dev
+			self.dev = dev
+			if path is not None:
+				self.path = path
+			self.connected = dev is not None
+			if old is not None:
+				try:
+					old.close()
+				except hid_errors:
+					pass
+			# the monitor may have been power cycled, so forget what was sent
+			lib27gn950.device_state(self).reset()
+
+
+################################################################################
+################################################################################
+
+
+class DeviceRegistry:
+	def __init__(self, ttl=2.0):
+		self.ttl = ttl
+		self.lock = Lock()
+		self.monitors = None
+		self.enumerated = 0.0
+		self.registered = {}
+		self.listeners = []
+		self.poll_thread = None
+		self.poll_stop = Event()
+
+	def enumerate(self, refresh=False):
+		with self.lock:
+			now = time.monotonic()
+			if refresh or self.monitors is None or now - self.enumerated > self.ttl:
+				self.monitors = lib27gn950.find_monitors()
+				self.enumerated = now
+			return self.monitors
+
+	def devices(self, refresh=False):
+		if refresh or self.monitors is None:
+			self.refresh(force=True)
+		with self.lock:
+			return [dev for dev in self.registered.values() if dev.connected]
+
+	def get(self, serial):
+		with self.lock:
+			return self.registered.get(serial)
+
+	def add_listener(self, callback):
+		self.listeners.append(callback)
+
+	def refresh(self, force=False):
+		monitors = {monitor_key(m): m for m in self.enumerate(force)}
+
+		with self.lock:
+			opened = []
+			for key, monitor in monitors.items():
+				dev = self.registered.get(key)
+				if dev is None:
+					dev = self.registered[key] = RegisteredDevice(self, monitor)
+				if not dev.connected or dev.path != monitor['path']:
+					opened.append((dev, monitor))
+			closed = [dev for key, dev in self.registered.items()
+				if dev.connected and key not in monitors]
+
+		# the registry lock isn't held here, as _set_handle takes device locks
+		added = []
+		for dev, monitor in opened:
+			try:
+				handle = open_device(monitor)
+			except hid_errors:
+				continue
+			was_connected = dev.connected
+			dev._set_handle(handle, monitor['path'])
+			if not was_connected:
+				added.append(dev)
+		for dev in closed:
+			dev._set_handle(None, None)
+
+		if added or closed:
+			for callback in self.listeners:
+				callback(added, closed)
+		return added, closed
+
+	def reopen(self, dev):
+		# called from a failed write, with the device locked
+		# only this device is touched, other changes are left to refresh()
+		for monitor in self.enumerate(refresh=True):
+			if monitor_key(monitor) == dev.key:
+				try:
+					handle = open_device(monitor)
+				except hid_errors:
+					break
+				dev._set_handle(handle, monitor['path'])
+				return True
+		dev._set_handle(None, None)
+		return False
+
+	def start_polling(self, interval=5.0):
+		if self.poll_thread is not None:
+			return
+		self.poll_stop.clear()
+		self.poll_thread = Thread(target=self._poll, args=(interval,), name='registry-poll', daemon=True)
+		self.poll_thread.start()
+
+	def _poll(self, interval):
+		while not self.poll_stop.wait(interval):
+			try:
+				self.refresh()
+			except Exception as e:
+				print(f'Error while polling for monitors: {e}')
+
+	def stop_polling(self):
+		if self.poll_thread is not None:
+			self.poll_stop.set()
+			self.poll_thread.join()
+			self.poll_thread = None
+
+	def close(self):
+		self.stop_polling()
+		with self.lock:
+			devs = list(self.registered.values())
+		for dev in devs:
+			dev.close()
+
+
+################################################################################
+
+_default_registry = None
+_default_registry_lock = Lock()
+
+def default_registry():
+	global _default_registry
+	with _default_registry_lock:
+		if _default_registry is None:
+			calibration.load()
+			flowcontrol.load()
+			_default_registry = DeviceRegistry()
+		return _default_registry
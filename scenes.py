@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+# Scenes: named lighting setups
+#
+# A scene holds the full state of each monitor, by serial number: power,
+#   mode, brightness and the colors of the four static color slots. It is
+#   saved from what the library knows the monitors are showing (see
+#   lib27gn950.device_state), and applying it only sends the commands that
+#   differ from that, to all monitors in parallel. Switching between scenes
+#   that share their colors and brightness is then a single mode command per
+#   monitor.
+#
+# Scenes are stored as JSON in scenes.json, in the same directory as
+#   config.ini. The last scene applied is recorded there too, and the GUI and
+#   the daemon restore it at startup. As the monitors' state isn't known at
+#   startup, restoring sends everything the scene sets, once.
+#
+# Available from:
+#   console.py   scene   scene NAME   scene save NAME   scene delete NAME
+#   gui.py       the Scenes row
+#   MQTT         the `scene` topic, and `scene/save`
+#
+#
+# File format:
+#   {"scenes": {"focus": {"<serial>": {"power": true, "mode": "color2",
+#                                      "brightness": 8,
+#                                      "colors": ["ff2b83", null, null, null]},
+#                         ...},
+#               ...},
+#    "active": "focus"}
+#   Any field can be null (or missing), for a state that wasn't known when the
+#     scene was saved. Those are left as they are when it's applied.
+#
+#
+# API documentation:
+#
+# Scene names are case insensitive. `devs` are open hid.Device instances (or
+#   registry.RegisteredDevices) with a serial number.
+#
+# names()
+#   Return the names of the saved scenes
+#
+# capture(devs)
+#   Return the current (known) state of the devices, as stored in a scene
+#
+# save(name, devs)
+#   Save the current state of the devices as a scene, replacing the devices'
+#     part of any scene with the same name, and return what was saved
+#
+# delete(name)
+#
+# plan(scene, devs)
+#   Return a dictionary mapping each device to the list of commands (as for
+#     lib27gn950.send_command) that would bring it to the scene, leaving out
+#     the devices that are already there and those that aren't in the scene.
+#     `scene` is a name, or a dictionary as returned by capture().
+#
+# apply(scene, devs)
+#   Send the plan() in parallel, record the scene as the active one if it is
+#     a name, and return the plan
+#
+# restore(devs)
+#   Apply the active scene, if there is one, and return the plan
+#
+# scenes_path()
+#   Return the path of scenes.json
+
+################################################################################
+
+import json
+import os
+from threading import Lock
+
+import devconfig
+import lib27gn950
+
+
+_lock = Lock()
+
+# a video sync mode needs a running stream, so scenes don't switch to it
+_scene_modes = {
+	name for name in lib27gn950.control_commands
+	if name.startswith('color') and name != 'color_video_sync'
+}
+
+
+def scenes_path():
+	return devconfig.config_path('scenes.json')
+
+
+def _read():
+	try:
+		with open(scenes_path()) as f:
+			data = json.load(f)
+	except FileNotFoundError:
+		data = {}
+	data.setdefault('scenes', {})
+	data.setdefault('active', None)
+	return data
+
+def _write(data):
+	path = scenes_path()
+	temporary = f'{path}.tmp'
+	with open(temporary, 'w') as f:
+		json.dump(data, f, indent=2)
+	os.replace(temporary, path)
+
+
+################################################################################
+################################################################################
+
+
+def names():
+	return sorted(_read()['scenes'])
+
+def capture(devs):
+	scene = {}
+	for dev in devs:
+		state = lib27gn950.device_state(dev)
+		scene[dev.serial] = {
+			'power': state.power,
+			'mode': state.mode if state.mode in _scene_modes else None,
+			'brightness': state.brightness,
+			'colors': list(state.colors),
+		}
+	return scene
+
+def save(name, devs):
+	name = name.lower()
+	with _lock:
+		data = _read()
+		scene = capture(devs)
+		data['scenes'].setdefault(name, {}).update(scene)
+		_write(data)
+	return scene
+
+def delete(name):
+	name = name.lower()
+	with _lock:
+		data = _read()
+		if name not in data['scenes']:
+			raise ValueError(f'no scene named {name!r}')
+		del data['scenes'][name]
+		if data['active'] == name:
+			data['active'] = None
+		_write(data)
+
+
+################################################################################
+################################################################################
+
+
+def _device_plan(target, state):
+	cmds = []
+	# colors first: setting a slot's color doesn't change what's shown unless
+	#   that slot is selected, which the mode command below takes care of
+	for slot, color in enumerate(target.get('colors') or [], 1):
+		if color is not None and state.colors[slot-1] != color:
+			cmds.append(lib27gn950.get_set_color_command(slot, color))
+
+	power = target.get('power')
+	mode = target.get('mode')
+	if power is False:
+		# brightness is left alone, so turning off never lights anything up
+		if state.power is not False:
+			cmds.append(lib27gn950.control_commands['turn_off'])
+		return cmds
+	if power is True:
+		if mode in _scene_modes and (state.mode != mode or state.power is not True):
+			# selecting a mode also turns the lighting on
+			cmds.append(lib27gn950.control_commands[mode])
+		elif state.power is not True:
+			cmds.append(lib27gn950.control_commands['turn_on'])
+	brightness = target.get('brightness')
+	if brightness is not None and state.brightness != brightness:
+		cmds.append(lib27gn950.brightness_commands[brightness])
+	return cmds
+
+def plan(scene, devs):
+	if type(scene) == str:
+		name = scene.lower()
+		scenes = _read()['scenes']
+		if name not in scenes:
+			raise ValueError(f'no scene named {name!r}')
+		scene = scenes[name]
+	result = {}
+	for dev in devs:
+		target = scene.get(dev.serial)
+		if target is None:
+			continue
+		cmds = _device_plan(target, lib27gn950.device_state(dev))
+		if cmds:
+			result[dev] = cmds
+	return result
+
+def apply(scene, devs):
+	result = plan(scene, devs)
+	lib27gn950.send_device_commands(result)
+	if type(scene) == str:
+		with _lock:
+			data = _read()
+			if data['active'] != scene.lower():
+				data['active'] = scene.lower()
+				_write(data)
+	return result
+
+def restore(devs):
+	data = _read()
+	if data['active'] is None or data['active'] not in data['scenes']:
+		return {}
+	return apply(data['scenes'][data['active']], devs)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+# Latest-wins command scheduler
+#
+# Some inputs produce many commands in a short time, e.g. dragging the GUI
+#   brightness slider fires for every step. Sending all of them just queues up
+#   USB writes that are immediately overwritten. The scheduler instead keeps at
+#   most one pending command per (key, device), replacing it when a newer one
+#   arrives, and sends what is pending from a background thread at no more
+#   than `rate` batches per second.
+#
+# Commands with different keys are sent in the order they were last submitted,
+#   so e.g. a brightness change followed by a turn_off ends with the lighting
+#   off, no matter how many brightness changes came before.
+#
+#
+# API documentation:
+#
+# CommandScheduler(rate=20)
+#   submit(cmd, dev, key=None, force=False)
+#     Schedule `cmd` for the device(s), replacing any pending command with the
+#       same key for the same device. Arguments are as for
+#       lib27gn950.send_command. If `key` is None, it is derived from the
+#       command with command_key().
+#   flush()
+#     Wait until everything submitted so far has been sent
+#   close()
+#     Send what is pending and stop the scheduler thread
+#   on_error
+#     Called with the exception if sending fails. Prints it by default.
+#
+#
+# command_key(cmd)
+#   Return the coalescing key for a command: 'power', 'mode', 'brightness' or
+#     ('color', slot). Commands that the library can't interpret get a unique
+#     key, so they are never replaced.
+#
+#
+# default_scheduler()
+#   Return a scheduler shared by the whole process
+
+################################################################################
+
+import time
+from threading import Condition, Lock, Thread
+
+import lib27gn950
+
+
+default_rate = 20
+
+
+def command_key(cmd):
+	if type(cmd) == str:
+		effect = lib27gn950.frame_effect(lib27gn950.compile_command(cmd))
+		if effect is not None:
+			field, value = effect
+			if field == 'color':
+				return ('color', value[0])
+			return field
+	return object()
+
+
+################################################################################
+
+class CommandScheduler:
+	def __init__(self, rate=default_rate):
+		self.interval = 1 / rate
+		self.condition = Condition()
+		self.pending = {}
+		self.submitted = 0
+		self.sent = 0
+		self.closed = False
+		self.on_error = lambda e: print(f'Error while sending a command: {e}')
+		self.thread = Thread(target=self._run, name='scheduler', daemon=True)
+		self.thread.start()
+
+	def submit(self, cmd, dev, key=None, force=False):
+		if key is None:
+			key = command_key(cmd)
+		if not hasattr(dev, '__iter__'):
+			dev = (dev,)
+		with self.condition:
+			if self.closed:
+				raise RuntimeError('CommandScheduler: submit() called after close()')
+			for _dev in dev:
+				# re-insert, so the dict stays ordered by the latest submission
+				self.pending.pop((key, _dev), None)
+				self.pending[(key, _dev)] = (cmd, force)
+			self.submitted += 1
+			self.condition.notify_all()
+
+	def flush(self):
+		with self.condition:
+			target = self.submitted
+			self.condition.wait_for(lambda: self.sent >= target or not self.thread.is_alive())
+
+	def close(self):
+		with self.condition:
+			self.closed = True
+			self.condition.notify_all()
+		self.thread.join()
+
+	def _run(self):
+		while True:
+			with self.condition:
+				self.condition.wait_for(lambda: self.pending or self.closed)
+				if not self.pending and self.closed:
+					return
+				pending = self.pending
+				self.pending = {}
+				submitted = self.submitted
+
+			started = time.monotonic()
+			try:
+				self._send(pending)
+			except Exception as e:
+				self.on_error(e)
+
+			with self.condition:
+				self.sent = submitted
+				self.condition.notify_all()
+
+			delay = self.interval - (time.monotonic() - started)
+			if delay > 0:
+				time.sleep(delay)
+
+	def _send(self, pending):
+		# group consecutive entries with the same command, so that each group
+		#   goes to all of its devices in parallel
+		groups = []
+		for (key, dev), item in pending.items():
+			if groups and groups[-1][0] == item:
+				groups[-1][1].append(dev)
+			else:
+				groups.append((item, [dev]))
+		for (cmd, force), devs in groups:
+			lib27gn950.send_command(cmd, devs, force)
+
+
+################################################################################
+
+_default_scheduler = None
+_default_scheduler_lock = Lock()
+
+def default_scheduler():
+	global _default_scheduler
+	with _default_scheduler_lock:
+		if _default_scheduler is None:
+			_default_scheduler = CommandScheduler()
+		return _default_scheduler
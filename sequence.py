@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+# Pre-rendered lighting sequences
+#
+# A sequence file holds video sync frames that are already encoded into their
+#   three reports (framed, CRC'd and padded), each with a timestamp. Playing
+#   one back needs no NumPy and does no encoding: the file is memory-mapped,
+#   and the reports are written to the monitors straight from the mapping, so
+#   even hour-long sequences are never loaded into memory.
+#
+#
+# File format (all integers little-endian):
+#   header, 32 bytes:
+#     magic            8 bytes   b'27GNSEQ\0'
+#     version          u16       1
+#     record size      u16       208
+#     reports          u16       3, per frame
+#     report size      u16       64
+#     (zero padding)
+#   records, one per frame, 208 bytes each:
+#     timestamp        u64       microseconds since the start of the sequence
+#     reports          3 x 65    each report preceded by a 0x00 byte, so that
+#                                they can be written with or without the
+#                                Windows report prefix without copying them
+#     (zero padding)   5 bytes
+#   The number of frames follows from the file size, so a recording that was
+#     interrupted is still readable up to its last complete frame.
+#
+#
+# API documentation:
+#
+# Sequence(path)
+#   A memory-mapped sequence file. len() is the number of frames.
+#   duration           the time from the first frame to the end of the last
+#                      one, in seconds
+#   timestamp(i)       the time of frame i, in seconds
+#   reports(i)         the three reports of frame i, ready to be written
+#   close()
+#
+# Player(sequence, devs, loop=False)
+#   Plays a Sequence to the device(s) at the recorded timing. If it can't keep
+#     up, late frames are skipped rather than played late.
+#   run()   start()   stop()   stats()
+#     The same as for a videosync.VideoSync pipeline. stats() returns the
+#       number of frames sent and skipped, and the loops played.
+#
+#
+# SequenceWriter(path)
+#   write(reports, t)      append a frame, given as the three reports from
+#                          lib27gn950.VideoSyncEncoder.encode()
+#   write_colors(colors, t)
+#                          append a frame, given as for send_video_sync_frame
+#   close()
+#   `t` is in seconds from the start of the sequence.
+#
+# Recorder(path)
+#   Records a live stream: a Recorder can be added to the devices of any
+#     video sync stream (a VideoSync pipeline, an effect, ...), and writes the
+#     video sync frames it receives to a sequence file, timestamped as they
+#     arrive. Other commands are ignored. Call close() when done.
+#
+# render(path, frames, fps)
+#   Write a sequence from an iterable of frames (as for write_colors), at
+#     `fps` frames per second, as fast as they can be encoded
+#
+#
+# Console commands, see `console.py help`:
+#   render FILE EFFECT [seconds=N] [fps=N] [effect options]
+#   record FILE [fps]
+#   play FILE [loop]
+
+################################################################################
+
+import ctypes
+import gc
+import mmap
+import struct
+import time
+from threading import Lock, Thread
+
+import lib27gn950
+
+
+magic = b'27GNSEQ\0'
+version = 1
+header = struct.Struct('<8sHHHH')
+header_size = 32
+reports_per_frame = 3
+report_size = lib27gn950.report_size
+slot_size = 1 + report_size
+record_size = 208
+timestamp = struct.Struct('<Q')
+
+
+class SequenceError(ValueError):
+	pass
+
+
+################################################################################
+################################################################################
+
+
+class Sequence:
+	def __init__(self, path):
+		self.file = open(path, 'rb')
+		# a private copy-on-write mapping, which ctypes can make views into;
+		#   nothing is ever written to it
+		self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_COPY)
+		if len(self.map) < header_size:
+			raise SequenceError(f'{path}: not a sequence file')
+		fields = header.unpack_from(self.map)
+		if fields[0] != magic:
+			raise SequenceError(f'{path}: not a sequence file')
+		if fields[1:] != (version, record_size, reports_per_frame, report_size):
+			raise SequenceError(f'{path}: unsupported sequence file version or layout')
+		self.frames = (len(self.map) - header_size) // record_size
+
+		# where each report starts within its slot, and how long it is
+		#   (the slot's leading zero byte is the Windows report prefix)
+		self.report_offset = 1 - len(lib27gn950.report_prefix)
+		self.report_type = ctypes.c_char * (len(lib27gn950.report_prefix) + report_size)
+
+	def __len__(self):
+		return self.frames
+
+	def timestamp(self, i):
+		return timestamp.unpack_from(self.map, header_size + i * record_size)[0] / 1e6
+
+	@property
+	def duration(self):
+		if self.frames == 0:
+			return 0.0
+		last = self.timestamp(self.frames - 1)
+		# the last frame lasts as long as the average frame
+		return last + (last / (self.frames - 1) if self.frames > 1 else 0.0)
+
+	def reports(self, i):
+		offset = header_size + i * record_size + timestamp.size + self.report_offset
+		return tuple(
+			self.report_type.from_buffer(self.map, offset + j * slot_size)
+			for j in range(reports_per_frame)
+		)
+
+	def close(self):
+		# the views from reports() keep the mapping exported for as long as
+		#   they are referenced. If one still is after collecting the garbage,
+		#   the mapping is freed along with the last one instead.
+		try:
+			self.map.close()
+		except BufferError:
+			gc.collect()
+			try:
+				self.map.close()
+			except BufferError:
+				pass
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+################################################################################
+
+class Player:
+	def __init__(self, sequence, devs, loop=False):
+		if not hasattr(devs, '__iter__'):
+			devs = (devs,)
+		self.sequence = sequence
+		self.devs = list(devs)
+		self.loop = loop
+		self.running = False
+		self.thread = None
+		self.sent = 0
+		self.skipped = 0
+		self.loops = 0
+
+	def run(self):
+		self.running = True
+		self._run()
+
+	def _run(self):
+		sequence = self.sequence
+		clock = time.perf_counter
+		self.sent = self.skipped = self.loops = 0
+		if not len(sequence):
+			self.running = False
+			return
+
+		lib27gn950.send_command(lib27gn950.control_commands['color_video_sync'], self.devs)
+		try:
+			base = clock()
+			while self.running:
+				for i in range(len(sequence)):
+					if not self.running:
+						break
+					deadline = base + sequence.timestamp(i)
+					delay = deadline - clock()
+					if delay > 0:
+						time.sleep(delay)
+					elif i + 1 < len(sequence) and base + sequence.timestamp(i + 1) < clock():
+						# the next frame is already due, skip this one
+						self.skipped += 1
+						continue
+					# no key, so nothing is skipped and the device state is left
+					#   unknown, as the frames aren't hashed
+					lib27gn950.send_video_sync_reports(sequence.reports(i), None, self.devs, force=True)
+					self.sent += 1
+				self.loops += 1
+				if not self.loop:
+					break
+				base += sequence.duration
+		finally:
+			self.running = False
+
+	def start(self):
+		self.running = True
+		self.thread = Thread(target=self._run, daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.running = False
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+
+	def stats(self):
+		return {'frames': self.sent, 'skipped': self.skipped, 'loops': self.loops}
+
+
+################################################################################
+################################################################################
+
+
+class SequenceWriter:
+	def __init__(self, path):
+		self.file = open(path, 'wb')
+		self.file.write(header.pack(magic, version, record_size, reports_per_frame, report_size).ljust(header_size, b'\0'))
+		self.record = bytearray(record_size)
+		self.encoder = None
+
+	def write(self, reports, t):
+		prefix = len(lib27gn950.report_prefix)
+		self._append([memoryview(report).cast('B')[prefix:] for report in reports], t)
+
+	def _append(self, reports, t):
+		# `reports` without the Windows report prefix
+		record = self.record
+		timestamp.pack_into(record, 0, round(t * 1e6))
+		for j, report in enumerate(reports):
+			offset = timestamp.size + j * slot_size + 1
+			record[offset:offset + report_size] = report
+		self.file.write(record)
+
+	def write_colors(self, colors, t):
+		if self.encoder is None:
+			self.encoder = lib27gn950.VideoSyncEncoder()
+		self.write(self.encoder.encode(colors), t)
+
+	def close(self):
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+
+class Recorder:
+	def __init__(self, path):
+		self.writer = SequenceWriter(path)
+		self.serial = 'recorder'
+		self.lock = Lock()
+		self.started = None
+		self.partial = []
+		self.frames = 0
+
+	def write(self, data):
+		report = bytes(data)[len(lib27gn950.report_prefix):]
+		with self.lock:
+			if not self.partial and report[:3] != b'\x53\x43\xc1':
+				# not the start of a video sync frame
+				return len(data)
+			self.partial.append(report)
+			if len(self.partial) == reports_per_frame:
+				now = time.perf_counter()
+				if self.started is None:
+					self.started = now
+				self.writer._append(self.partial, now - self.started)
+				self.partial.clear()
+				self.frames += 1
+		return len(data)
+
+	def read(self, size, timeout=None):
+		return b''
+
+	def close(self):
+		with self.lock:
+			self.writer.close()
+
+
+def render(path, frames, fps):
+	with SequenceWriter(path) as writer:
+		for i, colors in enumerate(frames):
+			writer.write_colors(colors, i / fps)
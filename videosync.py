@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+# Video sync capture pipeline
+#
+# Frames go through four stages, each of which is timed:
+#   capture   a FrameSource returns an (height, width, 3) uint8 RGB frame
+#   reduce    the frame is reduced to the 48 LED zones, a (48, 3) uint8 array
+#   encode    the zones are calibrated (see calibration.py) and encoded into
+#             the three video sync reports
+#   write     the reports are written to every device
+#
+# Requires NumPy. ScreenSource additionally requires Pillow.
+#
+#
+# API documentation:
+#
+# VideoSync(source, devs, fps=30, reducer=None, adaptive=True, min_fps=None,
+#           span=False)
+#   `source` is a FrameSource (see below)
+#   `devs` is an open hid.Device instance, or an iterable of them
+#   `fps` is the target frame rate. Frames are paced by a pacing.FramePacer,
+#     which lowers the rate (down to `min_fps`) when the frames can't be
+#     produced and written in time, unless `adaptive` is False.
+#   `reducer` is a callable taking a frame and returning a (48, 3) uint8
+#     array of zone colors. The default is a zones.ZoneSampler, which only
+#     looks at a precomputed sample of the border pixels.
+#   `span` spreads the frame across several monitors side by side: it is cut
+#     into len(devs) equal columns, the first one going to devs[0], each
+#     column is reduced to that monitor's zones, and the frames are written
+#     with lib27gn950.send_video_sync_frames(synchronized=True), so that all
+#     monitors change at the same time. The encode stage is then timed as
+#     part of the write stage.
+#   run(frames=None)   Run the pipeline on the current thread until the source
+#                      runs out of frames, `frames` frames have been sent, or
+#                      stop() is called
+#   start()            Run the pipeline on a background thread
+#   stop()             Stop the pipeline (and wait for its thread)
+#   stats()            Return a dictionary with the achieved fps, the number
+#                      of frames produced, sent ('frames') and dropped, the
+#                      pacing stats (effective_fps, jitter_ms, adjustments;
+#                      see pacing.py), and the mean / max time in ms spent in
+#                      each stage, for the current or most recent run. With
+#                      `span`, also the mean / max skew in ms between the
+#                      monitors ('skew').
+#   A frame is dropped when the pipeline runs so far behind that its time
+#     slot has passed. Pipelines are also listed in metrics.snapshot().
+#
+#
+# Frame sources:
+#   ScreenSource(bbox=None, all_screens=False)
+#     Grabs the screen (or the `bbox` = (left, top, right, bottom) part of it).
+#       With `all_screens`, the whole desktop across all screens (Windows
+#       only; on X11 the screen already covers every monitor).
+#   RawFileSource(path, width, height, loop=False)
+#     Reads raw packed RGB24 frames from a file, for example the output of
+#       ffmpeg -i video.mp4 -f rawvideo -pix_fmt rgb24 frames.rgb
+#   SyntheticSource(width, height, frames=None)
+#     Generates a moving color gradient, for testing without a screen
+#   Custom sources should subclass FrameSource and implement read(), which
+#     returns the next frame or None when there are no more frames.
+#
+#
+# border_zones(frame)
+#   Reduce a frame to the 48 LED zones, by averaging every pixel of the strips
+#     along the edge of the frame. This is exact, but much slower than
+#     zones.ZoneSampler. Zones are numbered as described in zones.py.
+
+################################################################################
+
+import time
+from threading import Thread
+
+import numpy as np
+
+import calibration
+import lib27gn950
+import metrics
+import zones
+from pacing import FramePacer
+from zones import zone_count
+
+
+################################################################################
+################################################################################
+
+
+class FrameSource:
+	def read(self):
+		raise NotImplementedError
+
+	def close(self):
+		pass
+
+
+class ScreenSource(FrameSource):
+	def __init__(self, bbox=None, all_screens=False):
+		from PIL import ImageGrab
+		self.grab = ImageGrab.grab
+		self.bbox = bbox
+		self.all_screens = all_screens
+
+	def read(self):
+		if self.all_screens:
+			return np.asarray(self.grab(bbox=self.bbox, all_screens=True).convert('RGB'))
+		return np.asarray(self.grab(bbox=self.bbox).convert('RGB'))
+
+
+class RawFileSource(FrameSource):
+	def __init__(self, path, width, height, loop=False):
+		self.file = open(path, 'rb')
+		self.loop = loop
+		self.frame = np.empty((height, width, 3), dtype=np.uint8)
+
+	def read(self):
+		if self.file.readinto(self.frame) == self.frame.nbytes:
+			return self.frame
+		if not self.loop:
+			return None
+		self.file.seek(0)
+		if self.file.readinto(self.frame) == self.frame.nbytes:
+			return self.frame
+		return None
+
+	def close(self):
+		self.file.close()
+
+
+class SyntheticSource(FrameSource):
+	def __init__(self, width, height, frames=None):
+		self.remaining = frames
+		self.index = 0
+		# uint8 arithmetic wraps around, which is what makes the gradient cycle
+		x = np.linspace(0, 255, width).astype(np.uint8)
+		y = np.linspace(0, 255, height).astype(np.uint8)
+		self.x = x[np.newaxis, :]
+		self.y = y[:, np.newaxis]
+		self.frame = np.empty((height, width, 3), dtype=np.uint8)
+
+	def read(self):
+		if self.remaining is not None:
+			if self.remaining <= 0:
+				return None
+			self.remaining -= 1
+		shift = np.uint8(self.index * 4 % 256)
+		self.index += 1
+		self.frame[:, :, 0] = self.x + shift
+		self.frame[:, :, 1] = self.y + shift
+		self.frame[:, :, 2] = self.x + self.y + shift
+		return self.frame
+
+
+################################################################################
+################################################################################
+
+
+def border_zones(frame, depth=0.1):
+	height, width = frame.shape[:2]
+	result = np.empty((zone_count, 3), dtype=np.uint8)
+	for i, (y0, y1, x0, x1) in enumerate(zones.zone_rects(width, height, depth=depth)):
+		result[i] = frame[y0:y1, x0:x1].mean(axis=(0, 1))
+	return result
+
+
+################################################################################
+################################################################################
+
+
+class StageTimer:
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def add(self, seconds):
+		self.count += 1
+		self.total += seconds
+		if seconds > self.max:
+			self.max = seconds
+
+	def summary(self):
+		mean = self.total / self.count if self.count else 0.0
+		return {'mean_ms': mean * 1000, 'max_ms': self.max * 1000}
+
+
+class VideoSync:
+	stages = ('capture', 'reduce', 'encode', 'write')
+
+	def __init__(self, source, devs, fps=30, reducer=None, adaptive=True, min_fps=None, span=False):
+		if not hasattr(devs, '__iter__'):
+			devs = (devs,)
+		self.source = source
+		self.devs = list(devs)
+		self.fps = fps
+		self.adaptive = adaptive
+		self.min_fps = min_fps
+		self.span = span
+		self.reducer = reducer or zones.ZoneSampler()
+		self.encoder = lib27gn950.VideoSyncEncoder()
+		self.running = False
+		self.thread = None
+		self.reset_stats()
+		metrics.pipelines.add(self)
+
+	def reset_stats(self):
+		self.timers = {stage: StageTimer() for stage in self.stages}
+		self.skew = StageTimer()
+		self.pacer = FramePacer(self.fps, self.min_fps, self.adaptive)
+		self.frames = 0
+		self.produced = 0
+		self.dropped = 0
+		self.started = None
+		self.finished = None
+
+	def run(self, frames=None):
+		self.running = True
+		self._run(frames)
+
+	def _run(self, frames=None):
+		clock = time.perf_counter
+		self.reset_stats()
+		pacer = self.pacer
+		timers = [self.timers[stage] for stage in self.stages]
+
+		lib27gn950.send_command(lib27gn950.control_commands['color_video_sync'], self.devs)
+
+		self.started = clock()
+		try:
+			while self.running and (frames is None or self.frames < frames):
+				pacer.wait()
+				t0 = clock()
+				frame = self.source.read()
+				if frame is None:
+					break
+				t1 = clock()
+				if self.span:
+					# a frame per monitor, encoded as part of the write
+					colors = self.reduce_columns(frame)
+					t2 = t3 = clock()
+					self.produced += 1
+					skew = lib27gn950.send_video_sync_frames(zip(self.devs, colors), synchronized=True)
+					if skew is not None:
+						self.skew.add(skew)
+				else:
+					colors = self.reducer(frame)
+					t2 = clock()
+					groups = calibration.device_groups(self.devs)
+					if groups is None or len(groups) == 1:
+						profile = groups[0][0] if groups else None
+						reports = self.encoder.encode(colors, profile)
+						self.produced += 1
+						t3 = clock()
+						lib27gn950.send_video_sync_reports(reports, self.encoder.key(), self.devs)
+					else:
+						# differently calibrated monitors, each encoded separately
+						#   (counted as part of the write)
+						self.produced += 1
+						t3 = clock()
+						lib27gn950.send_video_sync_frames({dev: colors for dev in self.devs})
+				t4 = clock()
+
+				timers[0].add(t1 - t0)
+				timers[1].add(t2 - t1)
+				timers[2].add(t3 - t2)
+				timers[3].add(t4 - t3)
+				self.frames += 1
+				pacer.frame_done(t4 - t0)
+				self.dropped = pacer.dropped
+		finally:
+			self.running = False
+			self.finished = clock()
+
+	def reduce_columns(self, frame):
+		# the reducer's result is reused by the next call, so copy each column's
+		width = frame.shape[1]
+		count = len(self.devs)
+		return [
+			self.reducer(frame[:, width * i // count:width * (i+1) // count]).copy()
+			for i in range(count)
+		]
+
+	def start(self):
+		self.running = True
+		self.thread = Thread(target=self._run, daemon=True)
+		self.thread.start()
+
+	def stop(self):
+		self.running = False
+		if self.thread is not None:
+			self.thread.join()
+			self.thread = None
+
+	def stats(self):
+		end = self.finished if not self.running else time.perf_counter()
+		elapsed = end - self.started if self.started is not None else 0.0
+		result = {
+			'frames': self.frames,
+			'produced': self.produced,
+			'dropped': self.dropped,
+			'target_fps': self.fps,
+			'fps': self.frames / elapsed if elapsed > 0 else 0.0,
+		}
+		pacing = self.pacer.stats()
+		for key in ['effective_fps', 'jitter_ms', 'adjustments']:
+			result[key] = pacing[key]
+		for stage in self.stages:
+			result[stage] = self.timers[stage].summary()
+		if self.span:
+			result['skew'] = self.skew.summary()
+		return result
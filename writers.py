@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# Per-device writer threads
+#
+# Every device gets a DeviceWriter, which owns a lock and (once it is first
+#   needed) a thread with a bounded queue of jobs. A job is a callable that is
+#   given the device, and runs with the device's lock held, so writes from
+#   different threads (e.g. the GUI and the MQTT bridge) never interleave.
+#   Jobs submitted to the same device run in the order they were submitted.
+#
+# lib27gn950 uses this for all of its writes: a command for a single device is
+#   written directly from the calling thread (under the device lock), and a
+#   command for several devices is queued to all of their writer threads at
+#   once, so the devices are updated in parallel instead of one after another.
+#
+#
+# API documentation:
+#
+# fan_out(job, devs)
+#   Run `job(dev)` for every device in `devs`, in parallel if there is more
+#     than one, and wait for all of them to finish. If any job raises an
+#     exception, the first one is re-raised after all jobs have finished.
+#
+#
+# get_writer(dev)
+#   Return the DeviceWriter for a device, creating it if needed
+#   DeviceWriter attributes and methods:
+#     lock          the lock that is held while a job runs
+#     submit(job, block=True)
+#                   queue `job`, and return a concurrent.futures.Future for its
+#                   result. Blocks while the queue is full, or raises
+#                   queue.Full if `block` is False.
+#     close()       stop the thread once the already queued jobs are done
+#
+#
+# close_writer(dev)   close_all()
+#   Stop the writer thread(s). This doesn't close the devices themselves.
+#
+#
+# queue_size
+#   The maximum number of queued jobs per device, used for new writers
+
+################################################################################
+
+from concurrent.futures import Future, wait
+from queue import Queue
+from threading import Lock, RLock, Thread
+
+
+queue_size = 64
+
+
+class DeviceWriter:
+	def __init__(self, dev, maxsize=None):
+		self.dev = dev
+		self.lock = RLock()
+		self.queue = Queue(maxsize or queue_size)
+		self.thread = None
+		self.thread_lock = Lock()
+
+	def submit(self, job, block=True):
+		future = Future()
+		if self.thread is None:
+			self._start()
+		self.queue.put((job, future), block)
+		return future
+
+	def _start(self):
+		with self.thread_lock:
+			if self.thread is None:
+				name = f'writer-{getattr(self.dev, "serial", id(self.dev))}'
+				self.thread = Thread(target=self._run, name=name, daemon=True)
+				self.thread.start()
+
+	def _run(self):
+		while True:
+			item = self.queue.get()
+			if item is None:
+				return
+			job, future = item
+			if not future.set_running_or_notify_cancel():
+				continue
+			try:
+				with self.lock:
+					result = job(self.dev)
+			except BaseException as e:
+				future.set_exception(e)
+			else:
+				future.set_result(result)
+
+	def close(self):
+		with self.thread_lock:
+			if self.thread is not None:
+				self.queue.put(None)
+				self.thread.join()
+				self.thread = None
+
+
+################################################################################
+
+_writers = {}
+_writers_lock = Lock()
+
+def get_writer(dev):
+	writer = _writers.get(dev)
+	if writer is None:
+		with _writers_lock:
+			writer = _writers.get(dev)
+			if writer is None:
+				writer = _writers[dev] = DeviceWriter(dev)
+	return writer
+
+def close_writer(dev):
+	with _writers_lock:
+		writer = _writers.pop(dev, None)
+	if writer is not None:
+		writer.close()
+
+def close_all():
+	with _writers_lock:
+		writers = list(_writers.values())
+		_writers.clear()
+	for writer in writers:
+		writer.close()
+
+
+################################################################################
+
+def fan_out(job, devs):
+	if len(devs) == 1:
+		dev = devs[0]
+		with get_writer(dev).lock:
+			job(dev)
+		return
+
+	futures = [get_writer(dev).submit(job) for dev in devs]
+	wait(futures)
+	for future in futures:
+		future.result()
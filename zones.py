@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# Screen to LED zone sampling for video sync
+#
+# Reducing a whole 4K frame to the 48 LED zones on every frame is slow, so
+#   this module works out once, per resolution and layout, which border pixels
+#   feed each zone. Each zone is sampled on a fixed grid of pixels, so the
+#   reduction of a frame is a single gather of a (48, samples, 3) array
+#   followed by a mean or median over it.
+#
+# Requires NumPy.
+#
+#
+# API documentation:
+#
+# ZoneSampler(sides=None, depth=0.1, grid=(8, 8), method='mean')
+#   A callable that reduces an (height, width, 3) uint8 frame to a (48, 3)
+#     uint8 array of zone colors. It can be passed as the `reducer` of a
+#     videosync.VideoSync pipeline (and is the default there).
+#   `sides` is the number of zones on the (top, right, bottom, left) sides.
+#     By default the zones are split in proportion to the side lengths.
+#   `depth` is how far into the frame each zone reaches, as a fraction of
+#     the frame height (top / bottom zones) or width (left / right zones)
+#   `grid` is the number of (rows, columns) of pixels sampled in each zone
+#   `method` is 'mean' or 'median'
+#   The sampling index is computed on the first frame, and recomputed only
+#     when the frame size changes. The returned array is reused by the next
+#     call, so copy it if it needs to be kept.
+#
+#
+# zone_index(width, height, sides=None, depth=0.1, grid=(8, 8))
+#   Return the (rows, columns) index arrays, each of shape (48, samples),
+#     such that frame[rows, columns] gathers the samples for every zone.
+#     Results are cached.
+#
+#
+# side_zone_counts(width, height, zones=48)
+#   Return the default number of zones on the (top, right, bottom, left)
+#     sides of a width x height frame.
+#
+#
+# Zones are numbered clockwise around the edge of the frame, starting from the
+#   top-left corner.
+#
+# Running this file benchmarks the sampler at the resolutions of the
+#   supported monitors.
+
+################################################################################
+
+from functools import lru_cache
+
+import numpy as np
+
+
+zone_count = 48
+
+
+################################################################################
+
+def side_zone_counts(width, height, zones=zone_count):
+	# split the zones between the sides in proportion to their length
+	horizontal = round(zones * width / (2 * (width + height)))
+	vertical = zones // 2 - horizontal
+	return (horizontal, vertical, horizontal, vertical)
+
+
+def zone_rects(width, height, sides=None, depth=0.1):
+	# returns a list of (y0, y1, x0, x1) rectangles, one per zone, in order
+	top, right, bottom, left = sides or side_zone_counts(width, height)
+	if top + right + bottom + left != zone_count:
+		raise ValueError(f'zone_rects: sides must add up to {zone_count} zones')
+	band_h = max(1, int(height * depth))
+	band_w = max(1, int(width * depth))
+
+	rects = []
+	# top: left to right, right: top to bottom,
+	# bottom: right to left, left: bottom to top
+	for n in range(top):
+		rects.append((0, band_h, width * n // top, width * (n+1) // top))
+	for n in range(right):
+		rects.append((height * n // right, height * (n+1) // right, width - band_w, width))
+	for n in reversed(range(bottom)):
+		rects.append((height - band_h, height, width * n // bottom, width * (n+1) // bottom))
+	for n in reversed(range(left)):
+		rects.append((height * n // left, height * (n+1) // left, 0, band_w))
+	return rects
+
+
+@lru_cache(maxsize=16)
+def zone_index(width, height, sides=None, depth=0.1, grid=(8, 8)):
+	rows, columns = grid
+	ys = np.empty((zone_count, rows * columns), dtype=np.intp)
+	xs = np.empty((zone_count, rows * columns), dtype=np.intp)
+	for i, (y0, y1, x0, x1) in enumerate(zone_rects(width, height, sides, depth)):
+		# sample the centers of a rows x columns grid of cells in the zone
+		y = y0 + ((np.arange(rows) * 2 + 1) * (y1 - y0)) // (2 * rows)
+		x = x0 + ((np.arange(columns) * 2 + 1) * (x1 - x0)) // (2 * columns)
+		ys[i] = np.repeat(y, columns)
+		xs[i] = np.tile(x, rows)
+	ys.flags.writeable = False
+	xs.flags.writeable = False
+	return ys, xs
+
+
+################################################################################
+
+class ZoneSampler:
+	def __init__(self, sides=None, depth=0.1, grid=(8, 8), method='mean'):
+		if method not in ('mean', 'median'):
+			raise ValueError("ZoneSampler: method must be 'mean' or 'median'")
+		self.sides = tuple(sides) if sides else None
+		self.depth = depth
+		self.grid = tuple(grid)
+		self.method = method
+		self.shape = None
+
+		samples = self.grid[0] * self.grid[1]
+		self.samples = samples
+		self.sums = np.empty((zone_count, 3), dtype=np.uint32)
+		self.zones = np.empty((zone_count, 3), dtype=np.uint8)
+
+	def __call__(self, frame):
+		if frame.shape[:2] != self.shape:
+			self.shape = frame.shape[:2]
+			height, width = self.shape
+			self.rows, self.columns = zone_index(width, height, self.sides, self.depth, self.grid)
+
+		gathered = frame[self.rows, self.columns]
+		if self.method == 'median':
+			self.zones[:] = np.median(gathered, axis=1)
+		else:
+			np.sum(gathered, axis=1, dtype=np.uint32, out=self.sums)
+			np.floor_divide(self.sums, self.samples, out=self.zones, casting='unsafe')
+		return self.zones
+
+
+################################################################################
+################################################################################
+
+# Benchmark
+
+if __name__ == '__main__':
+	from timeit import timeit
+
+	resolutions = (
+		('1080p', 1920, 1080),
+		('1440p', 2560, 1440),
+		('4K (27GN950)', 3840, 2160),
+		('5120x2160 (38GN950)', 5120, 2160),
+	)
+	sampler = ZoneSampler()
+	runs = 200
+	for name, width, height in resolutions:
+		frame = np.random.randint(0, 256, (height, width, 3), dtype=np.uint8)
+		first = timeit(lambda: ZoneSampler()(frame), number=1)
+		per_frame = timeit(lambda: sampler(frame), number=runs) / runs
+		print(f'{name:20} index + first frame {first*1000:7.3f} ms   per frame {per_frame*1000:7.3f} ms')